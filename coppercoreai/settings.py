@@ -183,4 +183,45 @@ CELERY_RESULT_BACKEND = config('CELERY_BROKER_REDIS_URL', default='redis://local
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TIMEZONE = 'Australia/Brisbane'
\ No newline at end of file
+CELERY_TIMEZONE = 'Australia/Brisbane'
+
+# CNN prediction: grids above this many pixels are streamed window by window instead of stacked in memory
+STREAMING_PIXEL_THRESHOLD = config('STREAMING_PIXEL_THRESHOLD', default=25_000_000, cast=int)
+
+# CNN prediction: split large grids into tiles of this many patch rows and
+# spread them over the Celery workers, merging the outputs in a final step
+PREDICTION_DISTRIBUTED = config('PREDICTION_DISTRIBUTED', default=True, cast=bool)
+PREDICTION_TILE_PATCH_ROWS = config('PREDICTION_TILE_PATCH_ROWS', default=8, cast=int)
+
+# Prediction result cache, keyed on input raster hashes, model hash and parameters
+PREDICTION_CACHE_ROOT = os.path.join(MEDIA_ROOT, 'prediction_cache')
+PREDICTION_CACHE_MAX_AGE = config('PREDICTION_CACHE_MAX_AGE', default=30 * 24 * 3600, cast=int)  # seconds since last use
+PREDICTION_CACHE_MAX_BYTES = config('PREDICTION_CACHE_MAX_BYTES', default=20 * 1024 ** 3, cast=int)
+
+# Number of distinct CNN model files (and exported inference engines) kept loaded per worker process
+MODEL_CACHE_SIZE = config('MODEL_CACHE_SIZE', default=3, cast=int)
+
+# CNN inference runtime on CPU workers: 'keras', 'tflite' (XNNPACK) or 'onnx' (needs tf2onnx + onnxruntime),
+# optionally with post-training 'float16' or 'int8' quantisation of the exported model
+PREDICTION_ENGINE = config('PREDICTION_ENGINE', default='keras')
+PREDICTION_QUANTIZATION = config('PREDICTION_QUANTIZATION', default='') or None
+PREDICTION_THREADS = config('PREDICTION_THREADS', default=0, cast=int) or None
+PREDICTION_INTER_OP_THREADS = config('PREDICTION_INTER_OP_THREADS', default=0, cast=int) or None
+
+# Compression of every GeoTIFF the pipeline writes: DEFLATE is readable everywhere, ZSTD is faster but needs GDAL >= 2.3
+COG_COMPRESS = config('COG_COMPRESS', default='DEFLATE')
+
+# Raster reprojection (GDAL warper): threads per warp ('ALL_CPUS' or a number) and working memory in MB
+WARP_THREADS = config('WARP_THREADS', default='ALL_CPUS')
+WARP_MEM_LIMIT = config('WARP_MEM_LIMIT', default=256, cast=int)
+
+# Proximity rasters: cap in metres on the distance to the nearest feature (converted to degrees on geographic
+# project grids); the cap sets each tile's halo, 0 computes exact distances with halos sized per tile instead
+PROXIMITY_MAX_DISTANCE = config('PROXIMITY_MAX_DISTANCE', default=10_000, cast=float) or None
+
+# Uploaded rasters are rewritten as COGs in the background; keep the untouched upload next to it in originals/
+KEEP_ORIGINAL_UPLOADS = config('KEEP_ORIGINAL_UPLOADS', default=False, cast=bool)
+
+# Resumable chunked uploads: bytes per chunk PUT, and seconds an unfinished session is kept before its partial file is dropped
+UPLOAD_CHUNK_SIZE = config('UPLOAD_CHUNK_SIZE', default=16 * 1024 * 1024, cast=int)
+UPLOAD_SESSION_MAX_AGE = config('UPLOAD_SESSION_MAX_AGE', default=2 * 24 * 3600, cast=int)
@@ -16,7 +16,7 @@ class geospatialDatasetsAdmin(admin.ModelAdmin):
 
 @admin.register(MLmodelRun)
 class MLmodelRunAdmin(admin.ModelAdmin):
-    list_display = ('model_name', 'project', 'predicted_at')
+    list_display = ('model_name', 'project', 'status', 'predicted_at')
     list_filter = ('project',)
     search_fields = ('model_name', 'project__name')  # Fixed: Search on project name
     filter_horizontal = ('input_data',)
@@ -1,6 +1,6 @@
 
 from django import forms
-from .models import prospectivityProject, geospatialDatasets
+from .models import prospectivityProject, geospatialDatasets, UploadSession
 from django.core.exceptions import ValidationError
 class ProspectivityProjectForm(forms.ModelForm):
     class Meta:
@@ -21,4 +21,23 @@ class GeospatialDatasetForm(forms.ModelForm):
             ext = file.name.split('.')[-1].lower()
             if ext not in ['tif', 'tiff', 'zip']:
                 raise ValidationError("This file type is not supported")
-        return file
\ No newline at end of file
+        return file
+
+class UploadSessionForm(forms.ModelForm):
+    # The dataset fields of GeospatialDatasetForm, checked before a chunked upload starts
+    class Meta:
+        model = UploadSession
+        fields = ['dataset_names', 'dataset_types', 'crs', 'band_info', 'file_name', 'file_size']
+
+    def clean_dataset_names(self):
+        name = self.cleaned_data.get('dataset_names')
+        if geospatialDatasets.objects.filter(dataset_names=name).exists():
+            raise ValidationError("Geospatial datasets with this Dataset names already exists.")
+        return name
+
+    def clean_file_name(self):
+        file_name = self.cleaned_data.get('file_name')
+        ext = file_name.split('.')[-1].lower()
+        if ext not in ['tif', 'tiff', 'zip']:
+            raise ValidationError("This file type is not supported")
+        return file_name
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prospectivity', '0008_geospatialdatasets_processed_file_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mlmodelrun',
+            name='outputs',
+            field=models.JSONField(blank=True, help_text='Output file paths relative to MEDIA_ROOT', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 11:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prospectivity', '0009_mlmodelrun_outputs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='geospatialdatasets',
+            name='band_statistics',
+            field=models.JSONField(blank=True, help_text='Per-band min, max, mean, std, percentiles, histogram and nodata fraction', null=True),
+        ),
+    ]
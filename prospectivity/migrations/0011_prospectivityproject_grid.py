@@ -0,0 +1,28 @@
+# Generated by Django 4.1.5 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prospectivity', '0010_geospatialdatasets_band_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prospectivityproject',
+            name='grid_transform',
+            field=models.JSONField(blank=True, help_text='Affine transform (a, b, c, d, e, f) of the project grid in the target CRS', null=True),
+        ),
+        migrations.AddField(
+            model_name='prospectivityproject',
+            name='grid_width',
+            field=models.PositiveIntegerField(blank=True, help_text='Project grid width in pixels', null=True),
+        ),
+        migrations.AddField(
+            model_name='prospectivityproject',
+            name='grid_height',
+            field=models.PositiveIntegerField(blank=True, help_text='Project grid height in pixels', null=True),
+        ),
+    ]
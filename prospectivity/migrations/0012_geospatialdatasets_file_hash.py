@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prospectivity', '0011_prospectivityproject_grid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='geospatialdatasets',
+            name='file_hash',
+            field=models.CharField(blank=True, help_text='sha256 of the uploaded file', max_length=64, null=True),
+        ),
+    ]
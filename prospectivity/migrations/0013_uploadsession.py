@@ -0,0 +1,35 @@
+# Generated by Django 4.1.5 on 2026-10-18 16:05
+
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('prospectivity', '0012_geospatialdatasets_file_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('dataset_names', models.TextField()),
+                ('dataset_types', models.CharField(choices=[('Raster', 'Raster'), ('Vector', 'Vector')], max_length=50)),
+                ('crs', models.CharField(choices=[('GCS', 'Gcs'), ('PCS', 'Pcs')], max_length=50)),
+                ('band_info', models.CharField(choices=[('RED', 'Red'), ('GREEN', 'Green'), ('BLUE', 'Blue')], max_length=20)),
+                ('file_name', models.CharField(max_length=255)),
+                ('file_size', models.BigIntegerField(validators=[django.core.validators.MinValueValidator(1)])),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('received_chunks', models.JSONField(blank=True, default=dict, help_text='sha256 of every stored chunk, keyed by offset')),
+                ('status', models.CharField(choices=[('Open', 'Open'), ('Assembling', 'Assembling'), ('Complete', 'Complete'), ('Failed', 'Failed')], default='Open', max_length=20)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('updated_on', models.DateTimeField(auto_now=True)),
+                ('dataset', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='prospectivity.geospatialdatasets')),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='prospectivity.prospectivityproject', verbose_name='Prospectivity Project')),
+            ],
+        ),
+    ]
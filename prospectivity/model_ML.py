@@ -1,96 +1,46 @@
 import rasterio
+from rasterio.windows import Window
+from rasterio.enums import MaskFlags
+from rasterio.features import geometry_mask
+from rasterio.warp import transform_geom
+from affine import Affine
 import numpy as np
 from tensorflow.keras.models import load_model
 import tensorflow as tf
-import geopandas as gpd
-from shapely.geometry import box
+from pyproj import Transformer
 import folium
 from folium.plugins import HeatMap
 import os
 import pandas as pd
 import logging
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from django.conf import settings
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
+from .raster_io import cog_writer, write_cog
 
 # Set up logging for debugging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def load_and_combine_tif_files(tif_paths, patch_size=128):
-    logger.info("Loading and combining TIFF files: %s", tif_paths)
-    datasets = [rasterio.open(path) for path in tif_paths]
-    target_shape = datasets[0].shape
-    transform = datasets[0].transform
-    crs = datasets[0].crs
-
-    # Verify all datasets have the same shape and CRS
-    for ds in datasets[1:]:
-        if ds.shape != target_shape:
-            raise ValueError(f"All raster datasets must have the same shape. Found {ds.shape} vs {target_shape}")
-        if ds.crs != crs:
-            raise ValueError(f"All raster datasets must have the same CRS. Found {ds.crs} vs {crs}")
-
-    # Read and stack bands from all datasets
-    bands = []
-    for ds in datasets:
-        data = ds.read()  # Shape: (bands, height, width)
-        data = np.transpose(data, [1, 2, 0])  # Shape: (height, width, bands)
-        # Take up to 3 bands; if fewer, use the first band repeatedly
-        num_bands = data.shape[-1]
-        if num_bands >= 3:
-            bands.extend([data[:, :, i] for i in range(3)])  
-        else:
-            for _ in range(3):
-                bands.append(data[:, :, 0] if num_bands >= 1 else np.zeros(target_shape))
-
-    # Stack bands to ensure 3 channels
-    combined_data = np.stack(bands[:3], axis=-1)  
-    logger.info("Combined data shape: %s", combined_data.shape)
-
-    # Normalize the combined data
-    combined_data = combined_data.astype('float32')
-    normalized_data = np.zeros_like(combined_data)
-    for k in range(combined_data.shape[-1]):
-        min_val = combined_data[:, :, k].min()
-        max_val = combined_data[:, :, k].max()
-        if max_val - min_val > 1e-6:
-            normalized_data[:, :, k] = (combined_data[:, :, k] - min_val) / (max_val - min_val)
-        else:
-            normalized_data[:, :, k] = np.zeros_like(combined_data[:, :, k])
-    combined_data = normalized_data
-
-    patches = []
-    patch_coords = []
-    h, w = combined_data.shape[:2]
-    for i in range(0, h - patch_size + 1, patch_size):
-        for j in range(0, w - patch_size + 1, patch_size):
-            patch = combined_data[i:i+patch_size, j:j+patch_size, :]
-            if patch.shape == (patch_size, patch_size, 3):  
-                patches.append(patch)
-                patch_coords.append((i, j))
-    patches = np.array(patches)
-    logger.info("Patches shape: %s", patches.shape)
-
-
-    for ds in datasets:
-        ds.close()
+# Default CNN model shipped with the app
+MODEL_PATH = os.path.join(os.path.dirname(__file__), 'model_ai', 'CNN_model.keras')
 
-    return patches, target_shape, patch_coords, patch_size, transform, crs
+# Process-wide model registry: model path -> (mtime_ns, size, sha256, model)
+_model_cache = OrderedDict()
+_model_cache_lock = threading.Lock()
 
-def reconstruct_prediction_map(predictions, original_shape, patch_coords, patch_size=128):
-    logger.info("Reconstructing prediction map with shape: %s", original_shape)
-    h, w = original_shape
-    prediction_map = np.zeros((h, w), dtype=np.float32)
-    for idx, (i, j) in enumerate(patch_coords):
-        value = predictions[idx][0]
-        prediction_map[i:i+patch_size, j:j+patch_size] = value
-    return prediction_map
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
-def load_and_generate_predictions(tif_paths, output_folder):
-    logger.info("Starting prediction process with TIFF paths: %s", tif_paths)
-    logger.info("TensorFlow version: %s", tf.__version__)
-    # Load the CNN model
-    model_path = os.path.join(os.path.dirname(__file__), 'model_ai', 'CNN_model.keras')
+def _load_cnn_model(model_path):
     logger.info("Loading model from: %s", model_path)
     try:
         model = load_model(model_path, compile=False)
@@ -117,49 +67,720 @@ def load_and_generate_predictions(tif_paths, output_folder):
                 model.compile(optimizer='adam', loss='binary_crossentropy')
             except Exception as e:
                 logger.error("All loading attempts failed: %s", str(e))
-                raise RuntimeError(f"Error loading model: %s", str(e))
+                raise RuntimeError(f"Error loading model: {str(e)}")
+    return model
+
+def get_cnn_model(model_path=MODEL_PATH):
+    """Return the compiled model for model_path, loading it at most once per process.
+
+    The cached model is reused until the file's mtime or size changes; the file is
+    then re-hashed and only reloaded if its content actually differs.
+    """
+    model_path = os.path.abspath(model_path)
+    stat = os.stat(model_path)
+    with _model_cache_lock:
+        entry = _model_cache.get(model_path)
+        if entry is not None:
+            mtime_ns, size, sha, model = entry
+            if (mtime_ns, size) == (stat.st_mtime_ns, stat.st_size):
+                _model_cache.move_to_end(model_path)
+                return model
+            new_sha = file_sha256(model_path)
+            if new_sha == sha:
+                _model_cache[model_path] = (stat.st_mtime_ns, stat.st_size, sha, model)
+                _model_cache.move_to_end(model_path)
+                return model
+            logger.info("Model file changed on disk, reloading: %s", model_path)
+            del _model_cache[model_path]
+        else:
+            new_sha = file_sha256(model_path)
+
+        model = _load_cnn_model(model_path)
+        _model_cache[model_path] = (stat.st_mtime_ns, stat.st_size, new_sha, model)
+        while len(_model_cache) > getattr(settings, 'MODEL_CACHE_SIZE', 3):
+            evicted_path, _ = _model_cache.popitem(last=False)
+            logger.info("Evicted model from cache: %s", evicted_path)
+        return model
+
+def model_fingerprint(model_path=MODEL_PATH):
+    """Content hash of a model file, served from the registry when it is already loaded."""
+    model_path = os.path.abspath(model_path)
+    stat = os.stat(model_path)
+    with _model_cache_lock:
+        entry = _model_cache.get(model_path)
+        if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+            return entry[2]
+    return file_sha256(model_path)
+
+# CPU inference engines: 'keras' runs the model as loaded, 'tflite' (XNNPACK) and
+# 'onnx' (onnxruntime, needs tf2onnx) run a one-off export of it.
+INFERENCE_ENGINES = ('keras', 'tflite', 'onnx')
+QUANTIZATIONS = (None, 'float16', 'int8')
+
+# Largest acceptable difference from the Keras output per quantisation mode
+PARITY_TOLERANCE = {None: 1e-4, 'float16': 1e-2, 'int8': 5e-2}
+
+# Exported models live next to the source model, keyed by its content hash
+EXPORT_DIR = os.path.join(os.path.dirname(__file__), 'model_ai', 'exports')
+
+_engine_cache = OrderedDict()
+_engine_cache_lock = threading.Lock()
+
+class KerasEngine:
+    name = 'keras'
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict_on_batch(self, batch):
+        return np.asarray(self.model.predict_on_batch(batch))
+
+    def predict(self, patches, batch_size=16):
+        return self.model.predict(patches, batch_size=batch_size)
+
+class _BatchedEngine:
+    # predict() in fixed-size batches on top of predict_on_batch()
+    def predict(self, patches, batch_size=16):
+        if len(patches) == 0:
+            return np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate([self.predict_on_batch(np.ascontiguousarray(patches[i:i + batch_size]))
+                               for i in range(0, len(patches), batch_size)])
+
+class TFLiteEngine(_BatchedEngine):
+    name = 'tflite'
+
+    def __init__(self, tflite_path, num_threads=None):
+        # The XNNPACK delegate is applied by default to float CPU graphs
+        self.interpreter = tf.lite.Interpreter(model_path=tflite_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+        self.lock = threading.Lock()
+
+    def predict_on_batch(self, batch):
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        # An interpreter is not reentrant; web threads share one per process
+        with self.lock:
+            if self.batch_size != len(batch):
+                self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+class OnnxEngine(_BatchedEngine):
+    name = 'onnx'
+
+    def __init__(self, onnx_path, num_threads=None, inter_op_threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        if inter_op_threads:
+            options.inter_op_num_threads = inter_op_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict_on_batch(self, batch):
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch, dtype=np.float32)})[0]
+
+def _calibration_patches(n=32, patch_size=128, seed=0):
+    # Inputs are min/max normalised, so uniform [0, 1] patches cover the input range
+    return np.random.default_rng(seed).random((n, patch_size, patch_size, 3), dtype=np.float32)
+
+def _export_tflite(model, export_path, quantization=None):
+    # The SavedModel fallback is read again by convert(), so its directory lives until then
+    with tempfile.TemporaryDirectory(prefix='cnn_savedmodel_') as saved_model_dir:
+        try:
+            converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        except Exception as e:
+            logger.warning("Direct Keras conversion failed (%s), converting via SavedModel", e)
+            model.export(saved_model_dir)
+            converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+        if quantization == 'float16':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantization == 'int8':
+            # Post-training integer quantisation; inputs and outputs stay float32
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([patch[np.newaxis]] for patch in _calibration_patches())
+        with open(export_path, 'wb') as f:
+            f.write(converter.convert())
+
+def _export_onnx(model, export_path, quantization=None):
+    try:
+        import tf2onnx
+    except ImportError:
+        raise RuntimeError("The onnx inference engine needs the tf2onnx and onnxruntime packages")
+    if quantization == 'float16':
+        raise ValueError("float16 quantisation is only supported by the tflite engine")
+    input_signature = [tf.TensorSpec([None] + list(model.input_shape[1:]), tf.float32, name='input')]
+    float_path = export_path if quantization is None else export_path + '.float.onnx'
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=17, output_path=float_path)
+    if quantization == 'int8':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(float_path, export_path, weight_type=QuantType.QInt8)
+        os.remove(float_path)
+
+def export_model(model_path=MODEL_PATH, engine='tflite', quantization=None):
+    """Export the Keras model once for a CPU runtime; returns the exported file path.
+
+    The export is named after the source model's content hash, so it is rebuilt only
+    when the .keras file changes.
+    """
+    if engine not in ('tflite', 'onnx'):
+        raise ValueError(f"Nothing to export for inference engine: {engine}")
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unsupported quantisation: {quantization}")
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    export_path = os.path.join(EXPORT_DIR, f"{stem}.{model_fingerprint(model_path)[:16]}.{quantization or 'float32'}.{engine}")
+    if os.path.exists(export_path):
+        return export_path
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    logger.info("Exporting %s to %s (%s)", model_path, engine, quantization or 'float32')
+    tmp_path = f"{export_path}.{os.getpid()}.tmp"
+    model = get_cnn_model(model_path)
+    if engine == 'tflite':
+        _export_tflite(model, tmp_path, quantization)
+    else:
+        _export_onnx(model, tmp_path, quantization)
+    os.replace(tmp_path, export_path)
+    return export_path
+
+def check_engine_parity(engine, reference=None, patches=None, atol=None, quantization=None):
+    """Compare an engine's output with the Keras model on the same patches.
+
+    Returns {'max_abs_diff', 'tolerance', 'passed'}.
+    """
+    reference = reference or KerasEngine(get_cnn_model())
+    patches = _calibration_patches(8) if patches is None else patches
+    atol = PARITY_TOLERANCE.get(quantization, 1e-4) if atol is None else atol
+    expected = np.asarray(reference.predict(patches)).reshape(-1)
+    actual = np.asarray(engine.predict(patches)).reshape(-1)
+    max_diff = float(np.abs(expected - actual).max()) if len(expected) else 0.0
+    result = {'max_abs_diff': max_diff, 'tolerance': atol, 'passed': max_diff <= atol}
+    logger.info("Parity of %s engine against Keras: %s", engine.name, result)
+    return result
+
+def configure_tf_threads(num_threads=None, inter_op_threads=None):
+    # Only effective before TensorFlow has run its first op in this process
+    try:
+        if num_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        logger.debug("TensorFlow threading already initialised: %s", e)
+
+def get_inference_engine(model_path=MODEL_PATH, engine='keras', quantization=None, num_threads=None,
+                         inter_op_threads=None):
+    """Return a warm inference engine exposing predict() and predict_on_batch().
+
+    Exported engines are parity-checked against Keras when first built; one that
+    drifts beyond PARITY_TOLERANCE is discarded in favour of the Keras model.
+    """
+    if engine not in INFERENCE_ENGINES:
+        raise ValueError(f"Unknown inference engine: {engine}")
+    if engine == 'keras':
+        configure_tf_threads(num_threads, inter_op_threads)
+        return KerasEngine(get_cnn_model(model_path))
+
+    export_path = export_model(model_path, engine, quantization)
+    key = (export_path, num_threads, inter_op_threads)
+    with _engine_cache_lock:
+        if key in _engine_cache:
+            _engine_cache.move_to_end(key)
+            return _engine_cache[key]
+
+    if engine == 'tflite':
+        runner = TFLiteEngine(export_path, num_threads)
+    else:
+        runner = OnnxEngine(export_path, num_threads, inter_op_threads)
+    parity = check_engine_parity(runner, KerasEngine(get_cnn_model(model_path)), quantization=quantization)
+    if not parity['passed']:
+        logger.error("%s export of %s failed the parity check (%s); using Keras", engine, model_path, parity)
+        runner = KerasEngine(get_cnn_model(model_path))
+
+    with _engine_cache_lock:
+        _engine_cache[key] = runner
+        while len(_engine_cache) > getattr(settings, 'MODEL_CACHE_SIZE', 3):
+            _engine_cache.popitem(last=False)
+    return runner
+
+# Probability above which a patch is flagged as a positive prediction
+BINARY_THRESHOLD = 0.95
+
+# Value written for skipped (nodata / out of boundary) patches and unpredicted edges
+PROBABILITY_NODATA = -1.0
+
+# Pixels read per window when scanning a band for statistics
+STATS_WINDOW_PIXELS = 4_000_000
+
+def _open_raster_stack(tif_paths):
+    datasets = [rasterio.open(path) for path in tif_paths]
+    target_shape = datasets[0].shape
+    crs = datasets[0].crs
+
+    # Verify all datasets have the same shape and CRS
+    try:
+        for ds in datasets[1:]:
+            if ds.shape != target_shape:
+                raise ValueError(f"All raster datasets must have the same shape. Found {ds.shape} vs {target_shape}")
+            if ds.crs != crs:
+                raise ValueError(f"All raster datasets must have the same CRS. Found {ds.crs} vs {crs}")
+    except ValueError:
+        for ds in datasets:
+            ds.close()
+        raise
+    return datasets
+
+def _channel_sources(datasets):
+    # Take up to 3 bands; if fewer, use the first band repeatedly.
+    # Returns the (dataset, band index) feeding each of the 3 CNN channels.
+    sources = []
+    for ds in datasets:
+        if ds.count >= 3:
+            sources.extend((ds, band) for band in (1, 2, 3))
+        else:
+            sources.extend((ds, 1) for _ in range(3))
+    return sources[:3]
+
+def _unique_sources(channel_sources):
+    # The distinct (dataset, band) reads behind the channels, and which of them feeds each channel
+    unique = list(dict.fromkeys(channel_sources))
+    return unique, [unique.index(source) for source in channel_sources]
+
+def _row_windows(ds, max_pixels=STATS_WINDOW_PIXELS):
+    rows_per_window = max(1, max_pixels // ds.width)
+    for row in range(0, ds.height, rows_per_window):
+        yield Window(0, row, ds.width, min(rows_per_window, ds.height - row))
+
+def stored_channel_statistics(datasets, channel_sources, raster_stats):
+    """Per-channel (min, max) taken from precomputed statistics, None where unavailable.
+
+    `raster_stats` is aligned with `datasets`; each entry is the `band_statistics`
+    stored on the dataset at ingest (see utils.raster_statistics) or None.
+    """
+    known = []
+    for ds, band in channel_sources:
+        stats = raster_stats[datasets.index(ds)] if raster_stats else None
+        bands = (stats or {}).get('bands') or []
+        entry = bands[band - 1] if len(bands) >= band else None
+        known.append((entry['min'], entry['max']) if entry and entry.get('min') is not None else None)
+    return known
 
-  
-    patches, original_shape, patch_coords, patch_size, transform, crs = load_and_combine_tif_files(tif_paths)
+def compute_band_statistics(channel_sources, known=None):
+    """Per-channel (min, max) of the valid pixels, computed window by window.
 
-    # Predict
-    logger.info("Generating predictions for %d patches with shape %s", len(patches), patches.shape)
-    predictions = model.predict(patches, batch_size=16)
-    probabilities = predictions
-    binary_predictions = (probabilities > 0.95).astype(np.int32)
+    Channels with an entry in `known` reuse it instead of scanning the band, and a band
+    feeding several channels is scanned once.
+    """
+    stats = []
+    scanned = {}
+    for k, (ds, band) in enumerate(channel_sources):
+        if known and known[k] is not None:
+            stats.append(tuple(known[k]))
+            continue
+        if (ds, band) not in scanned:
+            min_val, max_val = np.inf, -np.inf
+            for window in _row_windows(ds):
+                data = ds.read(band, window=window, masked=True)
+                if data.count():
+                    min_val = min(min_val, float(data.min()))
+                    max_val = max(max_val, float(data.max()))
+            scanned[ds, band] = (min_val, max_val) if min_val <= max_val else (0.0, 0.0)
+        stats.append(scanned[ds, band])
+    logger.info("Band statistics: %s", stats)
+    return stats
+
+def patch_validity_mask(datasets, patch_rows, n_patch_cols, patch_size=128, boundary=None, boundary_crs=None):
+    """Boolean (len(patch_rows), n_patch_cols) grid of the patches worth sending to the CNN.
+
+    A patch is skipped when it is entirely masked (nodata or mask band) in any input
+    raster, or lies outside `boundary` (a GeoJSON geometry in `boundary_crs`) when given.
+    `patch_rows` must be a contiguous range.
+    """
+    patch_rows = list(patch_rows)
+    valid = np.ones((len(patch_rows), n_patch_cols), dtype=bool)
+    if not patch_rows:
+        return valid
+    width = n_patch_cols * patch_size
+    for ds in datasets:
+        if all(flags == [MaskFlags.all_valid] for flags in ds.mask_flag_enums):
+            continue
+        for r_idx, row in enumerate(patch_rows):
+            mask = ds.dataset_mask(window=Window(0, row * patch_size, width, patch_size))
+            valid[r_idx] &= mask.reshape(patch_size, n_patch_cols, patch_size).any(axis=(0, 2))
+
+    if boundary is not None:
+        valid &= boundary_patch_mask(datasets[0], patch_rows, n_patch_cols, patch_size, boundary, boundary_crs)
+    return valid
+
+def boundary_patch_mask(ds, patch_rows, n_patch_cols, patch_size=128, boundary=None, boundary_crs=None):
+    """Boolean (len(patch_rows), n_patch_cols) grid of the patches touching `boundary`; None without one.
+
+    `boundary` is a GeoJSON geometry in `boundary_crs`, and `patch_rows` a contiguous range.
+    """
+    patch_rows = list(patch_rows)
+    if boundary is None or not patch_rows:
+        return None
+    geometry = transform_geom(boundary_crs, ds.crs, boundary) if boundary_crs else boundary
+    # One output pixel per patch
+    patch_transform = ds.transform * Affine.translation(0, patch_rows[0] * patch_size) * Affine.scale(patch_size)
+    return geometry_mask([geometry], out_shape=(len(patch_rows), n_patch_cols), transform=patch_transform,
+                         all_touched=True, invert=True)
+
+def load_patch_validity(tif_paths, patch_size=128, boundary=None, boundary_crs=None):
+    datasets = _open_raster_stack(tif_paths)
+    try:
+        n_rows, n_cols = datasets[0].height // patch_size, datasets[0].width // patch_size
+        valid = patch_validity_mask(datasets, range(n_rows), n_cols, patch_size, boundary, boundary_crs)
+    finally:
+        for ds in datasets:
+            ds.close()
+    logger.info("%d of %d patches contain valid data", valid.sum(), valid.size)
+    return valid
+
+def _normalize_channel(data, min_val, max_val):
+    # Min/max normalisation of a float32 channel, in place.
+    # Statistics cover valid pixels only, so nodata values are clipped into range.
+    if max_val - min_val > 1e-6:
+        data -= min_val
+        data /= (max_val - min_val)
+        np.clip(data, 0.0, 1.0, out=data)
+    else:
+        data[...] = 0.0
+
+def iter_patch_predictions(model, channel_sources, band_stats, patch_rows, n_patch_cols, patch_size=128, batch_size=16,
+                           valid=None):
+    """Yield (patch_row, first_patch_col, probabilities) for each batch of patches.
+
+    Each batch is read as one aligned window of `patch_size` rows, so memory is bounded
+    by the batch size rather than by the raster size; a band feeding several channels
+    is read once per window. Patches flagged False in `valid` (e.g. boundary_patch_mask's
+    output) are neither read nor predicted. Patches entirely masked (nodata or mask
+    band) in any raster feeding the channels are found from the same window read and
+    not predicted either. Both come back as NaN.
+    """
+    sources, channel_source = _unique_sources(channel_sources)
+    # Masks are only worth reading for rasters with nodata or a mask band
+    masked = [not all(flags == [MaskFlags.all_valid] for flags in ds.mask_flag_enums) for ds, _ in sources]
+    batch = np.empty((batch_size, patch_size, patch_size, 3), dtype=np.float32)
+    for r_idx, row in enumerate(patch_rows):
+        for col in range(0, n_patch_cols, batch_size):
+            n = min(batch_size, n_patch_cols - col)
+            keep = valid[r_idx, col:col + n].copy() if valid is not None else np.ones(n, dtype=bool)
+            probabilities = np.full(n, np.nan, dtype=np.float32)
+            if not keep.any():
+                yield row, col, probabilities
+                continue
+            window = Window(col * patch_size, row * patch_size, n * patch_size, patch_size)
+            reads = [ds.read(band, window=window, masked=is_masked)
+                     for (ds, band), is_masked in zip(sources, masked)]
+
+            # A raster has data in a patch when any of its bands has a valid pixel there
+            has_data = {}
+            for (ds, _), data, is_masked in zip(sources, reads, masked):
+                if is_masked:
+                    valid_pixels = ~np.ma.getmaskarray(data)
+                    patch_valid = valid_pixels.reshape(patch_size, n, patch_size).any(axis=(0, 2))
+                    has_data[ds] = has_data.get(ds, False) | patch_valid
+            for patch_valid in has_data.values():
+                keep &= patch_valid
+            if not keep.any():
+                yield row, col, probabilities
+                continue
+
+            patches = batch[:n]
+            for k, source in enumerate(channel_source):
+                if k > 0 and channel_source[k - 1] == source and band_stats[k - 1] == band_stats[k]:
+                    patches[..., k] = patches[..., k - 1]
+                    continue
+                data = np.ma.getdata(reads[source])
+                patches[..., k] = data.reshape(patch_size, n, patch_size).transpose(1, 0, 2)
+                _normalize_channel(patches[..., k], *band_stats[k])
+            selected = patches if keep.all() else patches[keep]
+            probabilities[keep] = np.asarray(model.predict_on_batch(selected)).reshape(-1)
+            yield row, col, probabilities
+
+def predict_windowed(model, tif_paths, prob_map_path, patch_size=128, batch_size=16, boundary=None, boundary_crs=None,
+                     raster_stats=None):
+    """Streaming counterpart of load_and_combine_tif_files + model.predict.
+
+    The probability map is written to prob_map_path one batch window at a time.
+    """
+    logger.info("Streaming predictions for TIFF files: %s", tif_paths)
+    datasets = _open_raster_stack(tif_paths)
+    try:
+        target_shape = datasets[0].shape
+        transform = datasets[0].transform
+        crs = datasets[0].crs
+        channel_sources = _channel_sources(datasets)
+        band_stats = compute_band_statistics(channel_sources,
+                                             stored_channel_statistics(datasets, channel_sources, raster_stats))
+
+        n_rows, n_cols = target_shape[0] // patch_size, target_shape[1] // patch_size
+        probabilities = np.full((n_rows * n_cols, 1), np.nan, dtype=np.float32)
+        patch_coords = patch_grid_coords(n_rows, n_cols, patch_size)
+        valid = boundary_patch_mask(datasets[0], range(n_rows), n_cols, patch_size, boundary, boundary_crs)
+
+        profile = datasets[0].profile
+        profile.update(dtype=rasterio.float32, count=1, nodata=PROBABILITY_NODATA, transform=transform)
+        with cog_writer(prob_map_path, profile) as dst:
+            for row, col, probs in iter_patch_predictions(model, channel_sources, band_stats, range(n_rows),
+                                                          n_cols, patch_size, batch_size, valid):
+                start = row * n_cols + col
+                probabilities[start:start + len(probs), 0] = probs
+                probs = np.nan_to_num(probs, nan=PROBABILITY_NODATA)
+                block = np.repeat(probs, patch_size)[np.newaxis, :].repeat(patch_size, axis=0)
+                dst.write(block, 1, window=Window(col * patch_size, row * patch_size, block.shape[1], patch_size))
+            logger.info("Predicted %d patch rows x %d patch columns", n_rows, n_cols)
+    finally:
+        for ds in datasets:
+            ds.close()
+    logger.info("Probability map saved to: %s", prob_map_path)
+    return probabilities, target_shape, patch_coords, patch_size, transform, crs
+
+def _read_preview(path, max_size=2048):
+    # Decimated read of a single-band raster, enough for a figure
+    with rasterio.open(path) as src:
+        scale = max(1.0, max(src.height, src.width) / max_size)
+        out_shape = (max(1, int(src.height / scale)), max(1, int(src.width / scale)))
+        return src.read(1, out_shape=out_shape)
+
+def patch_grid_coords(n_rows, n_cols, patch_size=128):
+    # Top-left (row, col) pixel of every patch, in row-major patch order
+    rows, cols = np.meshgrid(np.arange(n_rows) * patch_size, np.arange(n_cols) * patch_size, indexing='ij')
+    return np.column_stack([rows.ravel(), cols.ravel()])
+
+def load_and_combine_tif_files(tif_paths, patch_size=128, raster_stats=None):
+    logger.info("Loading and combining TIFF files: %s", tif_paths)
+    datasets = _open_raster_stack(tif_paths)
+    target_shape = datasets[0].shape
+    transform = datasets[0].transform
+    crs = datasets[0].crs
+
+    h, w = target_shape
+    n_rows, n_cols = h // patch_size, w // patch_size
+
+    # Bands are written straight into a patch-major buffer, so the final
+    # (n_patches, patch_size, patch_size, 3) array is a reshape, not a copy.
+    patches = np.empty((n_rows, n_cols, patch_size, patch_size, 3), dtype=np.float32)
+    image_view = patches.transpose(0, 2, 1, 3, 4)  # (n_rows, patch_size, n_cols, patch_size, 3)
+    channel_sources = _channel_sources(datasets)
+    known = stored_channel_statistics(datasets, channel_sources, raster_stats)
+    for k, (ds, band) in enumerate(channel_sources):
+        if k > 0 and channel_sources[k - 1] == (ds, band):
+            image_view[..., k] = image_view[..., k - 1]
+            continue
+        data = ds.read(band, masked=True)
+        # Normalise with statistics over the valid pixels of the full band, including the edge remainder
+        if known[k] is not None:
+            min_val, max_val = known[k]
+        elif data.count():
+            min_val, max_val = float(data.min()), float(data.max())
+        else:
+            min_val, max_val = 0.0, 0.0
+        image_view[..., k] = data.data[:n_rows * patch_size, :n_cols * patch_size].reshape(
+            n_rows, patch_size, n_cols, patch_size)
+        del data
+        _normalize_channel(patches[..., k], min_val, max_val)
+
+    patches = patches.reshape(-1, patch_size, patch_size, 3)
+    patch_coords = patch_grid_coords(n_rows, n_cols, patch_size)
+    logger.info("Patches shape: %s", patches.shape)
+
+    for ds in datasets:
+        ds.close()
+
+    return patches, target_shape, patch_coords, patch_size, transform, crs
+
+def reconstruct_prediction_map(predictions, original_shape, patch_coords, patch_size=128):
+    logger.info("Reconstructing prediction map with shape: %s", original_shape)
+    h, w = original_shape
+    n_rows, n_cols = h // patch_size, w // patch_size
+    coords = np.asarray(patch_coords).reshape(-1, 2)
+    grid = np.full((n_rows, n_cols), PROBABILITY_NODATA, dtype=np.float32)
+    values = np.nan_to_num(np.asarray(predictions, dtype=np.float32).reshape(-1), nan=PROBABILITY_NODATA)
+    grid[coords[:, 0] // patch_size, coords[:, 1] // patch_size] = values
+
+    # Broadcast each patch value over its block through a (n_rows, ps, n_cols, ps) view of the map
+    prediction_map = np.full((h, w), PROBABILITY_NODATA, dtype=np.float32)
+    blocks = prediction_map[:n_rows * patch_size, :n_cols * patch_size].reshape(n_rows, patch_size, n_cols, patch_size)
+    blocks[...] = grid[:, np.newaxis, :, np.newaxis]
+    return prediction_map
+
+def write_probability_map(prob_map_path, probabilities, original_shape, patch_size, profile):
+    # Write a patch-level probability grid one patch row at a time
+    h, w = original_shape
+    n_rows, n_cols = h // patch_size, w // patch_size
+    grid = np.nan_to_num(np.asarray(probabilities, dtype=np.float32).reshape(n_rows, n_cols), nan=PROBABILITY_NODATA)
+    profile = profile.copy()
+    profile.update(dtype=rasterio.float32, count=1, nodata=PROBABILITY_NODATA, width=w, height=h)
+    with cog_writer(prob_map_path, profile) as dst:
+        for row in range(n_rows):
+            block = np.repeat(grid[row], patch_size)[np.newaxis, :].repeat(patch_size, axis=0)
+            dst.write(block, 1, window=Window(0, row * patch_size, block.shape[1], patch_size))
+    logger.info("Probability map saved to: %s", prob_map_path)
+
+def prepare_prediction_grid(tif_paths, patch_size=128, raster_stats=None):
+    """Patch grid and normalisation statistics shared by every tile of a distributed run."""
+    datasets = _open_raster_stack(tif_paths)
+    try:
+        channel_sources = _channel_sources(datasets)
+        band_stats = compute_band_statistics(channel_sources,
+                                             stored_channel_statistics(datasets, channel_sources, raster_stats))
+        h, w = datasets[0].shape
+    finally:
+        for ds in datasets:
+            ds.close()
+    return {
+        'shape': [h, w],
+        'patch_size': patch_size,
+        'n_patch_rows': h // patch_size,
+        'n_patch_cols': w // patch_size,
+        'band_stats': band_stats,
+    }
+
+def predict_patch_rows(tif_paths, row_start, row_stop, band_stats, patch_size=128, batch_size=16, model_path=MODEL_PATH,
+                       boundary=None, boundary_crs=None, engine_options=None):
+    """Map step of a tiled run: probabilities for patch rows [row_start, row_stop), row-major."""
+    model = get_inference_engine(model_path, **(engine_options or {}))
+    datasets = _open_raster_stack(tif_paths)
+    try:
+        n_cols = datasets[0].width // patch_size
+        rows = range(row_start, row_stop)
+        valid = boundary_patch_mask(datasets[0], rows, n_cols, patch_size, boundary, boundary_crs)
+        probabilities = np.full((row_stop - row_start) * n_cols, np.nan, dtype=np.float32)
+        for row, col, probs in iter_patch_predictions(model, _channel_sources(datasets), band_stats,
+                                                      rows, n_cols, patch_size, batch_size, valid):
+            start = (row - row_start) * n_cols + col
+            probabilities[start:start + len(probs)] = probs
+    finally:
+        for ds in datasets:
+            ds.close()
+    logger.info("Predicted patch rows %d-%d", row_start, row_stop)
+    return probabilities
+
+def merge_tiled_predictions(tif_paths, tiles, output_folder, patch_size=128):
+    """Reduce step of a tiled run: assemble per-tile probabilities and write all outputs.
+
+    `tiles` is a list of (row_start, path to the tile's saved .npy probabilities).
+    """
+    with rasterio.open(tif_paths[0]) as src:
+        profile = src.profile
+        original_shape = src.shape
+        transform = src.transform
+        crs = src.crs
+    n_rows, n_cols = original_shape[0] // patch_size, original_shape[1] // patch_size
+
+    probabilities = np.full((n_rows * n_cols, 1), np.nan, dtype=np.float32)
+    for row_start, tile_path in tiles:
+        tile = np.load(tile_path)
+        start = row_start * n_cols
+        probabilities[start:start + len(tile), 0] = tile
+    logger.info("Merged %d tiles into %d patch predictions", len(tiles), len(probabilities))
+
+    prob_map_path = os.path.join(output_folder, 'probability_map.tif')
+    write_probability_map(prob_map_path, probabilities, original_shape, patch_size, profile)
+    patch_coords = patch_grid_coords(n_rows, n_cols, patch_size)
+    result = export_prediction_outputs(probabilities, patch_coords, patch_size, transform, crs, output_folder,
+                                       _read_preview(prob_map_path))
+    result['outputs']['probability_map'] = prob_map_path
+    result['metrics']['tiles'] = len(tiles)
+    return result
+
+def load_and_generate_predictions(tif_paths, output_folder, model_path=MODEL_PATH, streaming=None, batch_size=16,
+                                  progress=None, boundary=None, boundary_crs=None, engine_options=None, raster_stats=None):
+    """Run the CNN over the stacked rasters and write all prediction outputs to output_folder.
+
+    `progress`, if given, is called with a short status message at each stage.
+    Patches that are all nodata, or outside `boundary` (GeoJSON in `boundary_crs`), are skipped.
+    `engine_options` are passed to get_inference_engine (engine, quantization, threads).
+    `raster_stats`, aligned with tif_paths, are precomputed band statistics used for normalisation.
+    Returns a dict with the output file paths and summary metrics of the run.
+    """
+    logger.info("Starting prediction process with TIFF paths: %s", tif_paths)
+    logger.info("TensorFlow version: %s", tf.__version__)
+    report = progress or (lambda message: None)
+    report("Loading model")
+    model = get_inference_engine(model_path, **(engine_options or {}))
+    prob_map_path = os.path.join(output_folder, 'probability_map.tif')
+
+    # Large grids are streamed window by window instead of being stacked in memory
+    if streaming is None:
+        with rasterio.open(tif_paths[0]) as src:
+            streaming = src.width * src.height > getattr(settings, 'STREAMING_PIXEL_THRESHOLD', 25_000_000)
+
+    report("Running CNN inference")
+    if streaming:
+        probabilities, original_shape, patch_coords, patch_size, transform, crs = predict_windowed(
+            model, tif_paths, prob_map_path, batch_size=batch_size, boundary=boundary, boundary_crs=boundary_crs,
+            raster_stats=raster_stats)
+        prob_map = _read_preview(prob_map_path)
+    else:
+        patches, original_shape, patch_coords, patch_size, transform, crs = load_and_combine_tif_files(
+            tif_paths, raster_stats=raster_stats)
+        valid = load_patch_validity(tif_paths, patch_size, boundary, boundary_crs).reshape(-1)
+
+        # Predict only the patches that contain data
+        logger.info("Generating predictions for %d of %d patches with shape %s", valid.sum(), len(patches), patches.shape)
+        probabilities = np.full((len(patches), 1), np.nan, dtype=np.float32)
+        if valid.any():
+            selected = patches if valid.all() else patches[valid]
+            probabilities[valid] = model.predict(selected, batch_size=batch_size)
+
+        # Reconstruct probability map
+        prob_map = reconstruct_prediction_map(probabilities, original_shape, patch_coords, patch_size)
+
+        # Save probability map as .tiff
+        with rasterio.open(tif_paths[0]) as src:
+            profile = src.profile
+            profile.update(dtype=rasterio.float32, count=1, nodata=PROBABILITY_NODATA, transform=transform)
+        write_cog(prob_map_path, prob_map.astype(rasterio.float32), profile)
+        logger.info("Probability map saved to: %s", prob_map_path)
+
+    report("Writing prediction outputs")
+    result = export_prediction_outputs(probabilities, patch_coords, patch_size, transform, crs, output_folder, prob_map)
+    result['outputs']['probability_map'] = prob_map_path
+    result['metrics']['streaming'] = bool(streaming)
+    result['metrics']['engine'] = model.name
+    return result
+
+def export_prediction_outputs(probabilities, patch_coords, patch_size, transform, crs, output_folder, prob_map):
+    """Write the CSV, PNG heatmap and world map for a finished prediction.
+
+    `prob_map` is the probability map (or a decimated preview of it) used for the PNG.
+    """
+    probabilities = np.asarray(probabilities).reshape(-1, 1)
+    patch_coords = np.asarray(patch_coords).reshape(-1, 2)
+    valid = ~np.isnan(probabilities[:, 0])
+    binary_predictions = (probabilities > BINARY_THRESHOLD).astype(np.int32)
 
     # Export probabilities to CSV
+    csv_path = os.path.join(output_folder, 'predictions.csv')
     if len(patch_coords) == len(probabilities):
         df = pd.DataFrame({
-            'Patch_Top_Left_X_px': [coord[1] for coord in patch_coords],
-            'Patch_Top_Left_Y_px': [coord[0] for coord in patch_coords],
+            'Patch_Top_Left_X_px': patch_coords[:, 1],
+            'Patch_Top_Left_Y_px': patch_coords[:, 0],
             'Probability': probabilities.flatten(),
-            'Binary_Prediction': binary_predictions.flatten()
+            # Skipped patches are left empty in both columns
+            'Binary_Prediction': pd.Series(binary_predictions.flatten(), dtype='Int32').mask(~valid)
         })
-        csv_path = os.path.join(output_folder, 'predictions.csv')
         df.to_csv(csv_path, index=False)
         logger.info("Predictions saved to: %s", csv_path)
     else:
         logger.warning("Number of patch coordinates and predictions do not match. Skipping CSV export.")
 
-    # Reconstruct probability map
-    prob_map = reconstruct_prediction_map(probabilities, original_shape, patch_coords, patch_size)
-
-    # Save probability map as .tiff
-    with rasterio.open(tif_paths[0]) as src:
-        profile = src.profile
-        profile.update(dtype=rasterio.float32, count=1, nodata=0.0, transform=transform)
-    prob_map_path = os.path.join(output_folder, 'probability_map.tif')
-    with rasterio.open(prob_map_path, 'w', **profile) as dst:
-        dst.write(prob_map.astype(rasterio.float32), 1)
-    logger.info("Probability map saved to: %s", prob_map_path)
-
     # Generate and save heatmap as PNG
     plt.figure(figsize=(10, 8))
     cmap = mcolors.LinearSegmentedColormap.from_list(
         'custom', [(0, 'darkgreen'), (0.4, 'green'), (0.65, 'yellow'), (1, 'red')]
     )
-    plt.imshow(prob_map, cmap=cmap, vmin=0, vmax=1)
+    plt.imshow(np.ma.masked_equal(prob_map, PROBABILITY_NODATA), cmap=cmap, vmin=0, vmax=1)
     plt.colorbar(label='Probability')
     plt.title('Prediction Heatmap')
     plt.axis('off')
@@ -168,31 +789,51 @@ def load_and_generate_predictions(tif_paths, output_folder):
     plt.close()
     logger.info("Heatmap saved to: %s", heatmap_path)
 
-    # Generate world map with heatmap
-    geometries = []
-    prob_values = []
-    for (i, j), prob in zip(patch_coords, probabilities):
-        x_min, y_max = transform * (j, i)
-        x_max, y_min = transform * (j + patch_size, i + patch_size)
-        geometries.append(box(x_min, y_min, x_max, y_max))
-        prob_values.append(prob[0])
-
-    gdf = gpd.GeoDataFrame({'probability': prob_values, 'geometry': geometries}, crs=crs)
-    if crs != 'EPSG:4326':
-        gdf = gdf.to_crs(epsg=4326)
+    # Generate world map with heatmap: patch centres come straight from the affine
+    # transform and are reprojected in one call, no per-patch geometries needed
+    coords = patch_coords[valid]
+    prob_values = probabilities[valid, 0]
+    to_wgs84 = Transformer.from_crs(crs or 'EPSG:4326', 'EPSG:4326', always_xy=True)
+    half = patch_size / 2.0
+    xs, ys = transform * (coords[:, 1] + half, coords[:, 0] + half)
+    lons, lats = to_wgs84.transform(xs, ys)
 
-    map_center = [gdf.unary_union.centroid.y, gdf.unary_union.centroid.x]
-    m = folium.Map(location=map_center, zoom_start=5)
+    # Extent of the patch grid
+    left, top = transform * (patch_coords[:, 1].min(initial=0), patch_coords[:, 0].min(initial=0))
+    right, bottom = transform * (patch_coords[:, 1].max(initial=0) + patch_size,
+                                 patch_coords[:, 0].max(initial=0) + patch_size)
+    west, south, east, north = to_wgs84.transform_bounds(min(left, right), min(top, bottom),
+                                                         max(left, right), max(top, bottom))
 
-    bounds = [[gdf.geometry.bounds.miny.min(), gdf.geometry.bounds.minx.min()],
-              [gdf.geometry.bounds.maxy.max(), gdf.geometry.bounds.maxx.max()]]
-    folium.Rectangle(bounds=bounds, color='blue', fill=True, fill_opacity=0.2).add_to(m)
+    m = folium.Map(location=[(south + north) / 2, (west + east) / 2], zoom_start=5)
+    folium.Rectangle(bounds=[[south, west], [north, east]], color='blue', fill=True, fill_opacity=0.2).add_to(m)
 
-    heat_data = [[point.y, point.x, prob] for point, prob in zip(gdf.geometry.centroid, gdf['probability'])]
+    # Compact heat layer: rounded coordinates, zero-weight points dropped
+    keep = prob_values > 0
+    heat_data = np.column_stack([
+        np.round(np.asarray(lats)[keep], 5),
+        np.round(np.asarray(lons)[keep], 5),
+        np.round(prob_values[keep], 3),
+    ]).tolist()
     HeatMap(heat_data, radius=int(patch_size / 8.0), gradient={0.4: 'green', 0.65: 'yellow', 1: 'red'}).add_to(m)
 
     combined_map_path = os.path.join(output_folder, 'world_map_with_heatmap.html')
     m.save(combined_map_path)
     logger.info("Heatmap saved to: %s", combined_map_path)
 
-    return None
\ No newline at end of file
+    return {
+        'outputs': {
+            'csv': csv_path,
+            'heatmap': heatmap_path,
+            'world_map': combined_map_path,
+        },
+        'metrics': {
+            'n_patches': int(len(probabilities)),
+            'n_skipped': int((~valid).sum()),
+            'n_positive': int(binary_predictions.sum()),
+            'mean_probability': float(probabilities[valid].mean()) if valid.any() else None,
+            'max_probability': float(probabilities[valid].max()) if valid.any() else None,
+            'threshold': BINARY_THRESHOLD,
+            'patch_size': patch_size,
+        },
+    }
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+import uuid
 from django.db import models
 from django.urls import reverse
 from django.contrib.auth import get_user_model
@@ -34,6 +35,9 @@ class prospectivityProject(models.Model):
     mineral_type = models.CharField(max_length=255, blank=True)
     historical_production = models.FloatField(blank=True, null=True, help_text="in tonnes")
     target_crs = models.CharField(max_length=50, default="EPSG:4326", help_text="Target CRS for the project datasets")
+    grid_transform = models.JSONField(null=True, blank=True, help_text="Affine transform (a, b, c, d, e, f) of the project grid in the target CRS")
+    grid_width = models.PositiveIntegerField(null=True, blank=True, help_text="Project grid width in pixels")
+    grid_height = models.PositiveIntegerField(null=True, blank=True, help_text="Project grid height in pixels")
 
     class Meta:
         unique_together = ('name', 'project_code', 'description', 'project_status')
@@ -60,6 +64,8 @@ class geospatialDatasets(models.Model):
     updated_on = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, choices=status_choices.choices, default="Raw")
     task_message = models.TextField(blank=True, null=True)
+    file_hash = models.CharField(max_length=64, blank=True, null=True, help_text="sha256 of the uploaded file")
+    band_statistics = models.JSONField(null=True, blank=True, help_text="Per-band min, max, mean, std, percentiles, histogram and nodata fraction")
 
     class Meta:
         unique_together = ('project', 'dataset_names', 'dataset_types', 'file')
@@ -87,6 +93,30 @@ class MLmodelRun(models.Model):
     status = models.CharField(max_length=50, choices=run_choices.choices, default='pending')
     predicted_at = models.DateTimeField(auto_now=True)
     task_message = models.TextField(blank=True, null=True)
+    outputs = models.JSONField(null=True, blank=True, help_text="Output file paths relative to MEDIA_ROOT")
 
     def __str__(self):
-        return f"{self.model_name} ({self.status})"
\ No newline at end of file
+        return f"{self.model_name} ({self.status})"
+
+class UploadSession(models.Model):
+    # Resumable chunked upload of one dataset file: fixed-size chunks are PUT at their offsets,
+    # in any order and in parallel, then the session is completed into a geospatialDatasets row
+    status_choices = models.TextChoices("status", "Open Assembling Complete Failed")
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    project = models.ForeignKey(prospectivityProject, on_delete=models.CASCADE, verbose_name="Prospectivity Project")
+    dataset_names = models.TextField()
+    dataset_types = models.CharField(max_length=50, choices=geospatialDatasets.types.choices)
+    crs = models.CharField(max_length=50, choices=geospatialDatasets.crs_choices.choices)
+    band_info = models.CharField(max_length=20, choices=geospatialDatasets.band_types.choices)
+    file_name = models.CharField(max_length=255)
+    file_size = models.BigIntegerField(validators=[validators.MinValueValidator(1)])
+    chunk_size = models.PositiveIntegerField()
+    received_chunks = models.JSONField(default=dict, blank=True, help_text="sha256 of every stored chunk, keyed by offset")
+    status = models.CharField(max_length=20, choices=status_choices.choices, default="Open")
+    dataset = models.ForeignKey(geospatialDatasets, on_delete=models.SET_NULL, null=True, blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.file_name} ({self.status})"
@@ -0,0 +1,154 @@
+#content-addressed cache of CNN prediction outputs
+#key = hash of the input rasters (in stacking order) + model file + prediction parameters
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+from django.conf import settings
+from .model_ML import file_sha256, model_fingerprint
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+FILE_HASH_DIR = 'file_hashes'
+
+def cache_root():
+    root = getattr(settings, 'PREDICTION_CACHE_ROOT', None) or os.path.join(settings.MEDIA_ROOT, 'prediction_cache')
+    os.makedirs(root, exist_ok=True)
+    return root
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _file_hash_path(path):
+    return os.path.join(cache_root(), FILE_HASH_DIR, f"{hashlib.sha256(path.encode()).hexdigest()}.json")
+
+def raster_hash(path):
+    """sha256 of a file, remembered across runs for as long as its size and mtime are unchanged.
+
+    Each file's hash is kept in an entry of its own, replaced atomically, so workers
+    hashing different inputs at the same time never overwrite each other's entries.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    entry_path = _file_hash_path(path)
+    try:
+        with open(entry_path) as f:
+            entry = json.load(f)
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    sha = file_sha256(path)
+    os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+    _write_json(entry_path, {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha})
+    return sha
+
+def prune_file_hashes():
+    """Drop remembered hashes of files that no longer exist."""
+    hash_dir = os.path.join(cache_root(), FILE_HASH_DIR)
+    if not os.path.isdir(hash_dir):
+        return
+    for entry in os.scandir(hash_dir):
+        # Skips the temporary files of entries being written
+        if not entry.name.endswith('.json'):
+            continue
+        try:
+            with open(entry.path) as f:
+                path = json.load(f)['path']
+        except (OSError, ValueError, KeyError):
+            path = None
+        if path is None or not os.path.exists(path):
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def prediction_cache_key(tif_paths, model_path, params):
+    payload = {
+        'inputs': [raster_hash(path) for path in tif_paths],
+        'model': model_fingerprint(model_path),
+        'params': params,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def cache_lookup(key, output_dir):
+    """Copy a cached prediction into output_dir; returns a result dict like load_and_generate_predictions, or None."""
+    entry_dir = os.path.join(cache_root(), key)
+    manifest_path = os.path.join(entry_dir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    outputs = {}
+    for name, filename in manifest['files'].items():
+        target = os.path.join(output_dir, filename)
+        shutil.copy2(os.path.join(entry_dir, filename), target)
+        outputs[name] = target
+    # Entries are aged by last use
+    os.utime(manifest_path)
+    logger.info("Prediction cache hit: %s", key)
+    return {'outputs': outputs, 'metrics': dict(manifest['metrics'], cached=True)}
+
+def cache_store(key, result):
+    entry_dir = os.path.join(cache_root(), key)
+    if os.path.exists(entry_dir):
+        return
+    tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+    try:
+        files = {}
+        for name, path in result['outputs'].items():
+            if os.path.exists(path):
+                shutil.copy2(path, os.path.join(tmp_dir, os.path.basename(path)))
+                files[name] = os.path.basename(path)
+        _write_json(os.path.join(tmp_dir, MANIFEST), {'files': files, 'metrics': result['metrics']})
+        os.rename(tmp_dir, entry_dir)
+        logger.info("Stored prediction in cache: %s", key)
+    except OSError as e:
+        # Another worker stored the same key first, or the disk is full
+        logger.warning("Could not store prediction cache entry %s: %s", key, e)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict_prediction_cache()
+
+def _dir_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def evict_prediction_cache(max_age=None, max_bytes=None):
+    """Drop entries unused for longer than max_age seconds, then the least recently used until under max_bytes.
+
+    Remembered hashes of input files that have since been deleted are dropped too.
+    """
+    max_age = max_age if max_age is not None else getattr(settings, 'PREDICTION_CACHE_MAX_AGE', 30 * 24 * 3600)
+    max_bytes = max_bytes if max_bytes is not None else getattr(settings, 'PREDICTION_CACHE_MAX_BYTES', 20 * 1024 ** 3)
+    root = cache_root()
+    now = time.time()
+
+    entries = []
+    for entry in os.scandir(root):
+        manifest_path = os.path.join(entry.path, MANIFEST)
+        if not entry.is_dir() or not os.path.exists(manifest_path):
+            continue
+        last_used = os.path.getmtime(manifest_path)
+        if now - last_used > max_age:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            logger.info("Evicted expired prediction cache entry: %s", entry.name)
+            continue
+        entries.append((last_used, _dir_size(entry.path), entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        logger.info("Evicted prediction cache entry to free space: %s", os.path.basename(path))
+    prune_file_hashes()
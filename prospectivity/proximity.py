@@ -0,0 +1,170 @@
+#proximity rasters: distance from every cell of a grid to the nearest vector feature
+#computed tile by tile, each tile padded with a halo wide enough to see the features that can be nearest
+import math
+import logging
+import numpy as np
+import shapely
+from pyproj import CRS
+from rasterio.features import rasterize
+from rasterio.windows import (Window, bounds as window_bounds, transform as window_transform, intersection,
+                              union)
+from scipy.ndimage import distance_transform_edt
+from .raster_io import cog_writer, process_windows, PROCESS_WINDOW_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Largest burn canvas (tile plus halo) of an uncapped tile; the distance transform takes ~18 bytes a pixel,
+# so this keeps a tile under ~150 MB. Tiles that would need more are measured against the geometries directly
+MAX_CANVAS_PIXELS = 2 * PROCESS_WINDOW_SIZE ** 2
+
+# Spacing in pixels of the points sampled to size an uncapped tile's halo
+HALO_SAMPLE_STEP = 64
+
+# Metres in a degree along the equator, to apply distance caps on geographic grids
+METRES_PER_DEGREE = 111_320.0
+
+def metres_per_unit(crs):
+    """Length of one unit of a projected CRS in metres; None for geographic CRSs."""
+    crs = CRS.from_user_input(crs)
+    if not crs.is_projected:
+        return None
+    return crs.axis_info[0].unit_conversion_factor
+
+def grid_distance(metres, crs):
+    """A distance in metres in the units proximity is measured in on a grid in crs: metres, or degrees if geographic."""
+    return metres if metres_per_unit(crs) else metres / METRES_PER_DEGREE
+
+def _halo_window(window, halo):
+    # Not clamped to the grid: features just outside it still set the distances of the edge cells
+    return Window(window.col_off - halo, window.row_off - halo, window.width + 2 * halo, window.height + 2 * halo)
+
+def _extent_window(geometries, transform):
+    """Whole-pixel window covering the features' extent, with a pixel to spare on each side."""
+    minx, miny, maxx, maxy = shapely.total_bounds(geometries)
+    cols, rows = zip(*(~transform * xy for xy in ((minx, miny), (minx, maxy), (maxx, miny), (maxx, maxy))))
+    col_off, row_off = math.floor(min(cols)) - 1, math.floor(min(rows)) - 1
+    return Window(col_off, row_off, math.ceil(max(cols)) + 1 - col_off, math.ceil(max(rows)) + 1 - row_off)
+
+def _nearest_halo(tree, window, transform, step=HALO_SAMPLE_STEP):
+    """Halo in pixels that holds the nearest geometry of every cell in `window`.
+
+    The distance to the nearest geometry changes by at most one pixel per pixel, so its
+    largest value at points sampled every `step` pixels, plus the farthest a cell can be
+    from a sample point, bounds it over the whole window.
+    """
+    cols = np.unique(np.append(np.arange(0, window.width, step), window.width)) + window.col_off
+    rows = np.unique(np.append(np.arange(0, window.height, step), window.height)) + window.row_off
+    cols, rows = np.meshgrid(cols, rows)
+    xs, ys = transform * (cols.ravel().astype(float), rows.ravel().astype(float))
+    _, distances = tree.query_nearest(shapely.points(xs, ys), return_distance=True, all_matches=False)
+    pixel_size = min(abs(transform.a), abs(transform.e))
+    return math.ceil(distances.max() / pixel_size + step / math.sqrt(2)) + 2
+
+def vector_distance_tile(tree, window, transform, unit_scale=1.0, rows_per_step=64):
+    """float32 distances for `window` from each cell centre to the nearest geometry in `tree`.
+
+    Exact rather than rasterised, and memory is bounded by `rows_per_step` rows of points
+    whatever the distances are; used for tiles far from every feature.
+    """
+    distance = np.empty((window.height, window.width), dtype=np.float32)
+    cols = np.arange(window.col_off, window.col_off + window.width) + 0.5
+    for row in range(0, window.height, rows_per_step):
+        n = min(rows_per_step, window.height - row)
+        grid_cols, grid_rows = np.meshgrid(cols, np.arange(window.row_off + row, window.row_off + row + n) + 0.5)
+        xs, ys = transform * (grid_cols.ravel(), grid_rows.ravel())
+        (index, _), nearest = tree.query_nearest(shapely.points(xs, ys), return_distance=True, all_matches=False)
+        block = np.empty(grid_cols.size)
+        block[index] = nearest
+        distance[row:row + n] = (block * unit_scale).reshape(n, window.width)
+    return distance
+
+def proximity_tile(geometries, window, outer, transform, max_distance=None, unit_scale=1.0):
+    """float32 distances for `window`, from features burned into the larger `outer` window."""
+    pixel_size = (abs(transform.e) * unit_scale, abs(transform.a) * unit_scale)
+    fill = max_distance if max_distance is not None else np.nan
+    if len(geometries) == 0:
+        return np.full((window.height, window.width), fill, dtype=np.float32)
+    burned = rasterize(
+        ((geom, 1) for geom in geometries),
+        out_shape=(outer.height, outer.width),
+        transform=window_transform(outer, transform),
+        fill=0,
+        dtype='uint8'
+    )
+    if not burned.any():
+        return np.full((window.height, window.width), fill, dtype=np.float32)
+    row, col = window.row_off - outer.row_off, window.col_off - outer.col_off
+    distance = distance_transform_edt(burned == 0, sampling=pixel_size)
+    distance = distance[row:row + window.height, col:col + window.width].astype(np.float32)
+    if max_distance is not None:
+        np.minimum(distance, max_distance, out=distance)
+    return distance
+
+def prepare_geometries(geometries, pixel_size):
+    """Drop empty geometries and simplify the rest to half a pixel, below which detail cannot be burned."""
+    geometries = np.asarray([geom for geom in geometries if geom is not None and not geom.is_empty], dtype=object)
+    if pixel_size and len(geometries):
+        n_vertices = shapely.get_num_coordinates(geometries).sum()
+        # Plain Douglas-Peucker: burning does not need valid topology, only the
+        # geometries that would collapse to nothing are kept as they were
+        simplified = shapely.simplify(geometries, pixel_size / 2, preserve_topology=False)
+        collapsed = shapely.is_empty(simplified)
+        simplified[collapsed] = geometries[collapsed]
+        geometries = simplified
+        logger.info("Simplified %d geometries from %d to %d vertices", len(geometries), n_vertices,
+                    shapely.get_num_coordinates(geometries).sum())
+    return geometries
+
+def proximity_raster(geometries, dst_path, transform, width, height, crs, max_distance=None, simplify=True,
+                     unit_scale=1.0, tile_size=PROCESS_WINDOW_SIZE, max_canvas_pixels=MAX_CANVAS_PIXELS):
+    """Write the distance to the nearest geometry for every cell of the grid as a float32 COG.
+
+    Distances are in CRS units multiplied by `unit_scale` (see metres_per_unit). The grid
+    is processed in tiles of `tile_size` pixels, each burned onto a canvas padded by a
+    halo that reaches past the grid edges, so features outside the grid count too.
+    With `max_distance` the halo is max_distance and distances beyond it are capped.
+    Without a cap, each tile's halo is sized to hold the nearest geometry of all of its
+    cells, which keeps distances exact. Either way the canvas never extends past the
+    features' extent, and memory depends on the tile and halo size only. An uncapped
+    tile whose canvas would exceed `max_canvas_pixels` is far from every feature; its
+    distances are measured from cell centres to the geometries instead of burned.
+    Geometries are simplified to the pixel size unless `simplify` is False, and each
+    tile is burned with only the geometries an STRtree finds within its halo.
+    """
+    pixel_size = min(abs(transform.a), abs(transform.e))
+    geometries = prepare_geometries(geometries, pixel_size if simplify else None)
+    if max_distance is None and not len(geometries):
+        raise ValueError("Distances without a max_distance need at least one geometry")
+    halo = math.ceil(max_distance / (pixel_size * unit_scale)) + 1 if max_distance is not None else None
+    windows = list(process_windows(width, height, tile_size))
+
+    # Spatial index, to hand each tile only the features that can reach it
+    tree = shapely.STRtree(geometries)
+    extent = _extent_window(geometries, transform) if len(geometries) else None
+    vector_tiles = 0
+    profile = {
+        'driver': 'GTiff',
+        'height': height,
+        'width': width,
+        'count': 1,
+        'dtype': 'float32',
+        'crs': crs,
+        'transform': transform,
+        'nodata': None
+    }
+    with cog_writer(dst_path, profile) as dst:
+        for window in windows:
+            outer = _halo_window(window, halo if halo is not None else _nearest_halo(tree, window, transform))
+            if extent is not None:
+                # Canvas beyond the features' extent would only hold empty pixels
+                outer = intersection(outer, union(window, extent))
+            if max_distance is None and outer.width * outer.height > max_canvas_pixels:
+                distance = vector_distance_tile(tree, window, transform, unit_scale)
+                vector_tiles += 1
+            else:
+                near = tree.query(shapely.box(*window_bounds(outer, transform)))
+                distance = proximity_tile(geometries[near], window, outer, transform, max_distance, unit_scale)
+            dst.write(distance, 1, window=window)
+    logger.info("Proximity raster written to %s (%dx%d, %d tiles, %s, %d measured without burning)",
+                dst_path, width, height, len(windows),
+                f"halo {halo} px" if halo is not None else "halo per tile", vector_tiles)
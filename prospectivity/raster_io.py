@@ -0,0 +1,219 @@
+#shared raster writer: every raster the pipeline produces goes out as a Cloud-Optimized GeoTIFF
+#https://gdal.org/drivers/raster/cog.html
+import os
+import math
+import logging
+from contextlib import contextmanager
+from django.conf import settings
+import rasterio
+from rasterio.enums import Resampling, MaskFlags
+from rasterio.transform import Affine
+from rasterio.shutil import copy as copy_raster
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from rasterio.windows import Window
+from pyproj import CRS
+from pyproj.exceptions import CRSError
+
+logger = logging.getLogger(__name__)
+
+# Internal tile size of every output GeoTIFF (a multiple of the 128 px CNN patch)
+COG_BLOCKSIZE = 512
+
+# Output window processed per step by the windowed operations (a whole number of tiles)
+PROCESS_WINDOW_SIZE = COG_BLOCKSIZE * 4
+
+def cog_profile(profile, **updates):
+    """Copy of a rasterio profile set up for a tiled, compressed GeoTIFF."""
+    profile = dict(profile)
+    profile.update(updates)
+    profile.update(
+        driver='GTiff',
+        tiled=True,
+        blockxsize=COG_BLOCKSIZE,
+        blockysize=COG_BLOCKSIZE,
+        compress=getattr(settings, 'COG_COMPRESS', 'DEFLATE'),
+        predictor=3 if str(profile.get('dtype', '')).startswith('float') else 2,
+        BIGTIFF='IF_SAFER',
+    )
+    # Striped-layout options from the source profile do not apply to the output
+    for key in ('photometric', 'interleave'):
+        profile.pop(key, None)
+    return profile
+
+def overview_factors(width, height):
+    # Halve the resolution until the coarsest overview fits in a single tile
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > COG_BLOCKSIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+def finalize_cog(src_path, dst_path, overview_resampling=Resampling.average):
+    """Build internal overviews on src_path and rewrite it to dst_path with the COG layout."""
+    with rasterio.open(src_path, 'r+') as src:
+        factors = overview_factors(src.width, src.height)
+        if factors:
+            src.build_overviews(factors, overview_resampling)
+            src.update_tags(ns='rio_overview', resampling=overview_resampling.name)
+        profile = cog_profile(src.profile)
+
+    tmp_path = f"{os.path.splitext(dst_path)[0]}.cog{os.path.splitext(dst_path)[1]}"
+    copy_raster(
+        src_path, tmp_path,
+        driver='GTiff',
+        copy_src_overviews=True,
+        tiled=True,
+        blockxsize=profile['blockxsize'],
+        blockysize=profile['blockysize'],
+        compress=profile['compress'],
+        predictor=profile['predictor'],
+        BIGTIFF='IF_SAFER',
+    )
+    os.replace(tmp_path, dst_path)
+    logger.info("Wrote COG %s with overviews %s", dst_path, factors)
+
+@contextmanager
+def cog_writer(path, profile, overview_resampling=Resampling.average, **updates):
+    """Open a raster for writing and turn it into a COG at `path` when the block exits.
+
+    The yielded dataset is a tiled, uncompressed scratch GeoTIFF, so callers can write
+    it window by window in any order; compression and overviews are applied once at
+    the end and the result is moved into place atomically.
+    """
+    root, ext = os.path.splitext(path)
+    scratch_path = f"{root}.scratch{ext or '.tif'}"
+    profile = cog_profile(profile, **updates)
+    profile.update(compress=None, predictor=None)
+    profile = {key: value for key, value in profile.items() if value is not None}
+    try:
+        with rasterio.open(scratch_path, 'w', **profile) as dst:
+            yield dst
+        finalize_cog(scratch_path, path, overview_resampling)
+    finally:
+        if os.path.exists(scratch_path):
+            os.remove(scratch_path)
+
+def is_cog_layout(src):
+    """True when an open raster is already tiled, compressed and carries the overviews a COG would."""
+    return (bool(src.profile.get('tiled')) and src.compression is not None
+            and len(src.overviews(1)) >= len(overview_factors(src.width, src.height)))
+
+def convert_to_cog(src_path, dst_path, overview_resampling=Resampling.average):
+    """Rewrite a raster losslessly as a COG: same pixels, nodata, mask and colormap, new layout."""
+    with rasterio.open(src_path) as src:
+        has_mask = all(MaskFlags.per_dataset in flags for flags in src.mask_flag_enums)
+        with cog_writer(dst_path, src.profile, overview_resampling) as dst:
+            for window in process_windows(src.width, src.height):
+                dst.write(src.read(window=window), window=window)
+                if has_mask:
+                    dst.write_mask(src.dataset_mask(window=window), window=window)
+            try:
+                dst.write_colormap(1, src.colormap(1))
+            except ValueError:
+                pass  # no colormap
+            dst.update_tags(**src.tags())
+            dst.descriptions = src.descriptions
+    logger.info("Converted %s to COG %s", src_path, dst_path)
+
+def write_cog(path, data, profile, overview_resampling=Resampling.average, **updates):
+    """Write a whole (bands, rows, cols) or (rows, cols) array as a COG."""
+    with cog_writer(path, profile, overview_resampling, **updates) as dst:
+        if data.ndim == 2:
+            dst.write(data, 1)
+        else:
+            dst.write(data)
+
+def crs_equivalent(crs, other):
+    """True when two CRS definitions (EPSG code, WKT, PROJ string, rasterio or pyproj CRS) are the same."""
+    if not crs or not other:
+        return False
+    try:
+        crs, other = CRS.from_user_input(crs), CRS.from_user_input(other)
+    except CRSError:
+        return False
+    if crs.equals(other, ignore_axis_order=True):
+        return True
+    # WKT variants of the same registered CRS (e.g. from an ESRI .prj) still resolve to one EPSG code
+    epsg = crs.to_epsg()
+    return epsg is not None and epsg == other.to_epsg()
+
+def process_windows(width, height, size=PROCESS_WINDOW_SIZE):
+    """Tile-aligned windows covering a width x height raster, in row-major order."""
+    for row in range(0, height, size):
+        for col in range(0, width, size):
+            yield Window(col, row, min(size, width - col), min(size, height - row))
+
+def snapped_grid(bounds, resolution):
+    """(transform, width, height) of a north-up grid covering bounds, with edges on multiples of resolution."""
+    left, bottom, right, top = bounds
+    xres, yres = resolution
+    left, right = math.floor(left / xres) * xres, math.ceil(right / xres) * xres
+    bottom, top = math.floor(bottom / yres) * yres, math.ceil(top / yres) * yres
+    width, height = max(1, round((right - left) / xres)), max(1, round((top - bottom) / yres))
+    return Affine(xres, 0.0, left, 0.0, -yres, top), width, height
+
+def warp_to_grid(src_path, dst_path, dst_crs, transform, width, height, resampling=Resampling.nearest,
+                 num_threads=None, warp_mem_limit=None, overview_resampling=None, nodata=None):
+    """Warp a raster onto a fixed grid and write it as a COG, one output window at a time.
+
+    Reprojection, resampling and snapping happen in a single pass through a WarpedVRT,
+    so only the source pixels feeding the current window are read; GDAL splits each
+    window across `num_threads` threads and keeps its working buffers under
+    `warp_mem_limit` MB. Cells not covered by the source get `nodata` when given, or
+    the source's own nodata; without either they are marked in an internal mask, so
+    no real pixel value is taken over as nodata.
+    """
+    num_threads = num_threads or getattr(settings, 'WARP_THREADS', 'ALL_CPUS')
+    warp_mem_limit = warp_mem_limit or getattr(settings, 'WARP_MEM_LIMIT', 256)
+    # Nearest-neighbour data (classes, flags) keeps nearest-neighbour overviews
+    if overview_resampling is None:
+        overview_resampling = Resampling.nearest if resampling == Resampling.nearest else Resampling.average
+    with rasterio.open(src_path) as src:
+        profile = src.profile
+        profile.update(crs=dst_crs, transform=transform, width=width, height=height)
+        vrt_options = {}
+        if nodata is not None:
+            profile['nodata'] = nodata
+            vrt_options['nodata'] = nodata
+        # The warper's alpha band marks the cells the source covers (and its own mask)
+        use_mask = nodata is None and src.nodata is None
+        bands = list(range(1, src.count + 1))
+        with WarpedVRT(src, crs=dst_crs, transform=transform, width=width, height=height,
+                       resampling=resampling, warp_mem_limit=warp_mem_limit, add_alpha=use_mask,
+                       warp_extras={'NUM_THREADS': num_threads}, **vrt_options) as vrt:
+            with cog_writer(dst_path, profile, overview_resampling) as dst:
+                for window in process_windows(width, height):
+                    dst.write(vrt.read(bands, window=window), window=window)
+                    if use_mask:
+                        dst.write_mask(vrt.read(src.count + 1, window=window), window=window)
+    logger.info("Warped %s onto %dx%d grid in %s (%s)", src_path, width, height, dst_crs, resampling.name)
+
+def reproject_raster(src_path, dst_path, dst_crs, resampling=Resampling.nearest, num_threads=None,
+                     warp_mem_limit=None, overview_resampling=None):
+    """Reproject a raster to dst_crs on GDAL's default output grid; see warp_to_grid."""
+    with rasterio.open(src_path) as src:
+        transform, width, height = calculate_default_transform(
+            src.crs, dst_crs, src.width, src.height, *src.bounds
+        )
+    warp_to_grid(src_path, dst_path, dst_crs, transform, width, height, resampling,
+                 num_threads, warp_mem_limit, overview_resampling)
+    return transform, width, height
+
+def resample_raster(src, dst_path, profile, resampling=Resampling.bilinear):
+    """Write the open dataset `src` resampled onto the grid in `profile` (same extent) as a COG.
+
+    Each output window is filled from the matching fractional source window, so memory
+    stays bounded by the window size whatever the output dimensions are.
+    """
+    width, height = profile['width'], profile['height']
+    x_scale, y_scale = src.width / width, src.height / height
+    with cog_writer(dst_path, profile) as dst:
+        for window in process_windows(width, height):
+            src_window = Window(window.col_off * x_scale, window.row_off * y_scale,
+                                window.width * x_scale, window.height * y_scale)
+            data = src.read(window=src_window, out_shape=(src.count, window.height, window.width),
+                            resampling=resampling)
+            dst.write(data, window=window)
+    logger.info("Resampled %s to %dx%d (%s)", src.name, width, height, resampling.name)
@@ -1,8 +1,8 @@
 #https://medium.com/django-unleashed/asynchronous-tasks-in-django-a-step-by-step-guide-to-celery-and-docker-integration-b6f9898b66b5
 
-from celery import shared_task
+from celery import shared_task, group, chord, chain
 from .models import MLmodelRun
-from .models import geospatialDatasets
+from .models import geospatialDatasets, prospectivityProject
 import rasterio
 import os
 from rasterio import features
@@ -10,40 +10,206 @@ from pyproj import Proj, transform
 import fiona 
 from rasterio.enums import Resampling
 import geopandas as gpd 
-from scipy.ndimage import distance_transform_edt
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.warp import calculate_default_transform, transform_bounds, Resampling
+from rasterio.transform import Affine
 from django.conf import settings
 from django.db import transaction
 import shutil
-from rasterio.features import rasterize
-from scipy.ndimage import distance_transform_edt
 import numpy as np
 import time
+import json
+import logging
+import matplotlib.pyplot as plt
+from .raster_io import (reproject_raster, resample_raster, warp_to_grid, snapped_grid,
+                        crs_equivalent, is_cog_layout, convert_to_cog)
+from .model_ML import (load_and_generate_predictions, prepare_prediction_grid, predict_patch_rows,
+                       merge_tiled_predictions, file_sha256, MODEL_PATH, BINARY_THRESHOLD)
+from .prediction_cache import prediction_cache_key, cache_lookup, cache_store
+from .utils import raster_statistics, convert_to_flatgeobuf, dataset_vector_path, read_vector
+from .proximity import proximity_raster, metres_per_unit, grid_distance
+
+logger = logging.getLogger(__name__)
+
+def prediction_output_dir(project):
+    output_dir = os.path.join(settings.MEDIA_ROOT, 'geospatial_datasets', project.name, 'outputs')
+    os.makedirs(output_dir, exist_ok=True)
+    return output_dir
+
+def project_boundary(project):
+    # Project boundary as (GeoJSON geometry, CRS) for masking predictions, if one is set
+    if not project.boundary:
+        return None, None
+    return json.loads(project.boundary.geojson), f"EPSG:{project.boundary.srid or 4326}"
+
+def prediction_engine_options():
+    # CPU inference runtime used by every prediction task (see model_ML.get_inference_engine)
+    return {
+        'engine': getattr(settings, 'PREDICTION_ENGINE', 'keras'),
+        'quantization': getattr(settings, 'PREDICTION_QUANTIZATION', None),
+        'num_threads': getattr(settings, 'PREDICTION_THREADS', None),
+        'inter_op_threads': getattr(settings, 'PREDICTION_INTER_OP_THREADS', None),
+    }
+
+def exact_band_statistics(datasets):
+    # Stored statistics usable for normalisation; approximate ones fall back to a band scan
+    return [ds.band_statistics if ds.band_statistics and not ds.band_statistics.get('approximate') else None
+            for ds in datasets]
+
+def _complete_model_run(modelRun, result, started):
+    metrics = result['metrics']
+    metrics['duration_seconds'] = round(time.time() - started, 2)
+    outputs = {
+        name: os.path.relpath(path, settings.MEDIA_ROOT).replace("\\", "/")
+        for name, path in result['outputs'].items() if os.path.exists(path)
+    }
+    modelRun.performance_metrics = metrics
+    modelRun.outputs = outputs
+    modelRun.review_result.name = outputs.get('probability_map')
+    modelRun.status = "Achieved"
+    if metrics.get('cached'):
+        modelRun.task_message = f"Reused cached prediction of {metrics['n_patches']} patches"
+    else:
+        modelRun.task_message = f"Predicted {metrics['n_patches']} patches in {metrics['duration_seconds']}s"
+    modelRun.save()
+    print(f"Model run updated: Status={modelRun.status}, Message={modelRun.task_message}")
+    return modelRun.task_message
 
 @shared_task
 def MLmodelRunTask(modelRunId):
+    print(f"Starting model run: {modelRunId}")
+    modelRun = MLmodelRun.objects.select_related('project').get(id=modelRunId)
     try:
-        modelRun = MLmodelRun.objects.get(id = modelRunId)
-        modelRunStatus = "Running"
+        modelRun.status = "Running"
+        modelRun.task_message = "Preparing input datasets"
         modelRun.save()
 
-        #load dataset
-        #prepare features
-        #split the data
-        #train the model
-        #evaluate model
+        input_datasets = list(modelRun.input_data.all())
+        tif_paths = [dataset.file.path for dataset in input_datasets]
+        raster_stats = exact_band_statistics(input_datasets)
+        if not tif_paths:
+            raise ValueError("No raster datasets selected for this model run")
+        output_dir = prediction_output_dir(modelRun.project)
+        boundary, boundary_crs = project_boundary(modelRun.project)
+        started = time.time()
+
+        # Identical inputs, model and parameters reuse the stored outputs
+        modelRun.task_message = "Checking prediction cache"
+        modelRun.save(update_fields=['task_message'])
+        engine_options = prediction_engine_options()
+        prediction_params = {'patch_size': 128, 'threshold': BINARY_THRESHOLD, 'normalization': 'valid_pixels',
+                             'boundary': boundary, 'boundary_crs': boundary_crs,
+                             'engine': engine_options['engine'], 'quantization': engine_options['quantization']}
+        cache_key = prediction_cache_key(tif_paths, MODEL_PATH, prediction_params)
+        modelRun.parameters = dict(modelRun.parameters or {}, cache_key=cache_key)
+        modelRun.save(update_fields=['parameters'])
+        cached = cache_lookup(cache_key, output_dir)
+        if cached:
+            return _complete_model_run(modelRun, cached, started)
+
+        # Large grids are split into tiles and fanned out across the worker pool
+        if getattr(settings, 'PREDICTION_DISTRIBUTED', False):
+            grid = prepare_prediction_grid(tif_paths, raster_stats=raster_stats)
+            tile_rows = getattr(settings, 'PREDICTION_TILE_PATCH_ROWS', 8)
+            if grid['n_patch_rows'] > tile_rows:
+                return dispatch_prediction_tiles(modelRun, tif_paths, grid, tile_rows, output_dir, started,
+                                                 boundary, boundary_crs, cache_key, engine_options)
+
+        def progress(message):
+            modelRun.task_message = message
+            modelRun.save(update_fields=['task_message'])
+
+        result = load_and_generate_predictions(tif_paths, output_dir, progress=progress,
+                                               boundary=boundary, boundary_crs=boundary_crs,
+                                               engine_options=engine_options, raster_stats=raster_stats)
+        cache_store(cache_key, result)
+        return _complete_model_run(modelRun, result, started)
 
-        #update model run status
-        modelRunStatus = "Completed"
-        modelRunAccuracy = "Accuracy"
-        modelRun.modelPath = "modelPath"
+    except Exception as e:
+        print(f"Error in MLmodelRunTask: {str(e)}")
+        modelRun.status = "Failed"
+        modelRun.task_message = f"Prediction failed: {str(e)}"
         modelRun.save()
-    
+        raise
+
+def dispatch_prediction_tiles(modelRun, tif_paths, grid, tile_rows, output_dir, started,
+                              boundary=None, boundary_crs=None, cache_key=None, engine_options=None):
+    tile_dir = os.path.join(output_dir, 'tiles', f"run_{modelRun.id}")
+    os.makedirs(tile_dir, exist_ok=True)
+    tiles = [
+        predict_tile_task.s(tif_paths, row_start, min(row_start + tile_rows, grid['n_patch_rows']),
+                            grid['band_stats'], tile_dir, boundary, boundary_crs, engine_options)
+        for row_start in range(0, grid['n_patch_rows'], tile_rows)
+    ]
+    merge = merge_prediction_tiles_task.s(modelRun.id, tif_paths, tile_dir, started, cache_key)
+    merge.on_error(prediction_tiles_failed.s(modelRun.id, tile_dir))
+
+    modelRun.task_message = f"Dispatched {len(tiles)} prediction tiles to workers"
+    modelRun.save(update_fields=['task_message'])
+    print(modelRun.task_message)
+    chord(group(tiles))(merge)
+    return modelRun.task_message
+
+@shared_task
+def predict_tile_task(tif_paths, row_start, row_stop, band_stats, tile_dir, boundary=None, boundary_crs=None,
+                      engine_options=None):
+    probabilities = predict_patch_rows(tif_paths, row_start, row_stop, band_stats,
+                                       boundary=boundary, boundary_crs=boundary_crs, engine_options=engine_options)
+    tile_path = os.path.join(tile_dir, f"tile_{row_start:06d}.npy")
+    np.save(tile_path, probabilities)
+    return [row_start, tile_path]
+
+@shared_task
+def merge_prediction_tiles_task(tiles, modelRunId, tif_paths, tile_dir, started, cache_key=None):
+    modelRun = MLmodelRun.objects.select_related('project').get(id=modelRunId)
+    try:
+        modelRun.task_message = f"Merging {len(tiles)} prediction tiles"
+        modelRun.save(update_fields=['task_message'])
+        result = merge_tiled_predictions(tif_paths, tiles, prediction_output_dir(modelRun.project))
+        shutil.rmtree(tile_dir, ignore_errors=True)
+        if cache_key:
+            cache_store(cache_key, result)
+        return _complete_model_run(modelRun, result, started)
     except Exception as e:
-        modelRunStatus = "Failed"
-        modelRun.error_message = str(e)
+        print(f"Error in merge_prediction_tiles_task: {str(e)}")
+        modelRun.status = "Failed"
+        modelRun.task_message = f"Prediction failed: {str(e)}"
         modelRun.save()
-        raise 
+        raise
+
+@shared_task
+def prediction_tiles_failed(request, exc, traceback, modelRunId, tile_dir=None):
+    # Error callback of the tile chord: a tile (or the merge) failed; the tiles already written are dropped
+    print(f"Prediction tiles failed for model run {modelRunId}: {exc}")
+    MLmodelRun.objects.filter(id=modelRunId).update(status="Failed", task_message=f"Prediction failed: {exc}")
+    if tile_dir:
+        shutil.rmtree(tile_dir, ignore_errors=True)
+
+@shared_task
+def computeBandStatistics(dataset_id):
+    # Replace the quick statistics taken at upload with an exact full-resolution pass
+    dataset = geospatialDatasets.objects.get(id=dataset_id)
+    if dataset.dataset_types.lower() != "raster":
+        return None
+    path = dataset.file.path
+    source_stat = os.stat(path)
+    stats = raster_statistics(path, exact=True)
+    # A preprocessing task may have replaced the file while we were reading it, under
+    # another name or by os.replace onto the same path
+    dataset.refresh_from_db()
+    stat = os.stat(path) if os.path.exists(path) else None
+    if dataset.file.path != path or stat is None or \
+            (stat.st_ino, stat.st_mtime_ns) != (source_stat.st_ino, source_stat.st_mtime_ns):
+        return None
+    dataset.band_statistics = stats
+    dataset.save(update_fields=['band_statistics'])
+    print(f"Exact band statistics stored for dataset {dataset_id}")
+    return stats
+
+def refresh_band_statistics(dataset):
+    # The raster behind the dataset was rewritten: store quick statistics now, exact ones in the background
+    dataset.band_statistics = raster_statistics(dataset.file.path)
+    dataset.save(update_fields=['band_statistics'])
+    computeBandStatistics.delay(dataset.id)
 
 
 #crs harmonisation
@@ -51,7 +217,7 @@ def MLmodelRunTask(modelRunId):
 
 TARGET_CRS = "EPSG:4326"
 @shared_task
-def crsHarmonization(dataset_id, target_crs="EPSG:4326"):
+def crsHarmonization(dataset_id, target_crs="EPSG:4326", resampling="nearest"):
     project_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
     
     # Construct absolute paths for PROJ_LIB and GDAL_DATA
@@ -63,7 +229,7 @@ def crsHarmonization(dataset_id, target_crs="EPSG:4326"):
     os.environ['GDAL_DATA'] = gdal_data_path
     print(f"PROJ_LIB set to: {os.environ['PROJ_LIB']}")
     print(f"GDAL_DATA set to: {os.environ['GDAL_DATA']}")
-    print(f"Starting CRS Harmonization for dataset ID: {dataset_id}, Target CRS: {target_crs}")
+    print(f"Starting CRS Harmonization for dataset ID: {dataset_id}, Target CRS: {target_crs}, Resampling: {resampling}")
     
     try:
         dataset = geospatialDatasets.objects.get(id=dataset_id)
@@ -71,35 +237,39 @@ def crsHarmonization(dataset_id, target_crs="EPSG:4326"):
         
         input_path = dataset.file.path
         print(f"Input file path: {input_path}")
+
+        # Nothing to do when the data is already in the target CRS
+        if dataset.dataset_types.lower() == "raster":
+            with rasterio.open(input_path) as src:
+                source_crs = src.crs
+        elif dataset.dataset_types.lower() == "vector":
+            with fiona.open(dataset_vector_path(dataset)) as src:
+                source_crs = src.crs_wkt
+        else:
+            source_crs = None
+        if crs_equivalent(source_crs, target_crs):
+            dataset.status = "Ready"
+            dataset.task_message = f"Already in target CRS {target_crs}, no reprojection needed"
+            dataset.save()
+            print(f"Dataset updated: Status={dataset.status}, Message={dataset.task_message}")
+            return dataset.task_message
         
         if dataset.dataset_types.lower() == "vector":
-            gdf = gpd.read_file(input_path)
-            print(f"Original CRS: {gdf.crs}")
-            gdf = gdf.to_crs(target_crs)
-            print(f"Reprojected to CRS: {gdf.crs}")
-            # Create temporary reprojected file
-            temp_path = input_path.replace(".shp", "_reprojected.shp")
-            gdf.to_file(temp_path, driver='GeoJSON')
+            # Features are streamed in batches into a reprojected FlatGeobuf, which replaces the
+            # dataset's processed file; the upload itself is kept as it came
+            output_path = f"{os.path.splitext(input_path)[0]}.fgb"
+            temp_path = f"{os.path.splitext(input_path)[0]}_reprojected.fgb"
+            dropped = convert_to_flatgeobuf(dataset_vector_path(dataset), temp_path, dst_crs=target_crs)
+            if dropped:
+                logger.warning("Dropped %d features without geometry from dataset %s", dropped, dataset_id)
             print(f"Created temporary reprojected vector: {temp_path}")
-            
-            # Delete the original file and associated files
-            if os.path.exists(input_path):
-                os.remove(input_path)
-                print(f"Deleted original file: {input_path}")
-                # Remove associated vector files (.shx, .dbf, etc.)
-                base_name = os.path.splitext(input_path)[0]
-                for ext in ['.shx', '.dbf', '.prj', '.cpg']:
-                    assoc_file = f"{base_name}{ext}"
-                    if os.path.exists(assoc_file):
-                        os.remove(assoc_file)
-                        print(f"Deleted associated file: {assoc_file}")
-            
-            # Rename the temporary file to the original name
+
+            # Rename the temporary file to the processed file name
             max_retries = 5
             for attempt in range(max_retries):
                 try:
-                    os.replace(temp_path, input_path)
-                    print(f"Renamed reprojected file to original name: {input_path}")
+                    os.replace(temp_path, output_path)
+                    print(f"Renamed reprojected file to: {output_path}")
                     break
                 except PermissionError as e:
                     if attempt == max_retries - 1:
@@ -108,43 +278,21 @@ def crsHarmonization(dataset_id, target_crs="EPSG:4326"):
                         raise e
                     print(f"Permission error on attempt {attempt + 1}, retrying after delay: {str(e)}")
                     time.sleep(1)
-            
+
+            dataset.processed_file.name = os.path.relpath(output_path, settings.MEDIA_ROOT).replace("\\", "/")
             dataset.status = "Ready"
-            base_name = os.path.splitext(input_path)[0]
-            relative_path = input_path.split('geospatial_datasets\\')[-1]
-            dataset.task_message = f"Reprojected vector renamed to geospatial_datasets\\{relative_path}"
+            dataset.task_message = f"Reprojected vector written to {dataset.processed_file.name}"
             
         elif dataset.dataset_types.lower() == "raster":
-            # Read the raster data
-            src = rasterio.open(input_path)
-            print(f"Original CRS: {src.crs}")
-            transform, width, height = calculate_default_transform(
-                src.crs, target_crs, src.width, src.height, *src.bounds
-            )
-            profile = src.profile
-            profile.update({
-                'crs': target_crs,
-                'transform': transform,
-                'width': width,
-                'height': height
-            })
-            
-            # Create temporary reprojected file
+            # Create temporary reprojected file, warped window by window across all cores
             temp_path = input_path.replace(".tif", "_reprojected.tif")
-            with rasterio.open(temp_path, 'w', **profile) as dst:
-                for i in range(1, src.count + 1):
-                    reproject(
-                        source=rasterio.band(src, i),
-                        destination=rasterio.band(dst, i),
-                        src_transform=src.transform,
-                        src_crs=src.crs,
-                        dst_transform=transform,
-                        dst_crs=target_crs,
-                        resampling=rasterio.enums.Resampling.nearest
-                    )
-            # Explicitly close the source file
-            src.close()
-            print(f"Created temporary reprojected raster: {temp_path}")
+            transform, width, height = reproject_raster(
+                input_path, temp_path, target_crs,
+                resampling=Resampling[resampling],
+                num_threads=getattr(settings, 'WARP_THREADS', None),
+                warp_mem_limit=getattr(settings, 'WARP_MEM_LIMIT', None),
+            )
+            print(f"Created temporary reprojected raster: {temp_path} ({width}x{height}, {resampling})")
             
             # Delete the original file
             if os.path.exists(input_path):
@@ -174,6 +322,8 @@ def crsHarmonization(dataset_id, target_crs="EPSG:4326"):
             raise ValueError("Unsupported dataset type")
         
         dataset.save()
+        if dataset.dataset_types.lower() == "raster":
+            refresh_band_statistics(dataset)
         print(f"Dataset updated: Status={dataset.status}, Message={dataset.task_message}")
         return dataset.task_message
     except Exception as e:
@@ -262,12 +412,6 @@ def resampleRaster(dataset_id, reference_raster):
                 new_pixel_size_x, new_pixel_size_y
             )
 
-            # Resample
-            data = src.read(
-                out_shape=(src.count, new_height, new_width),
-                resampling=Resampling.bilinear
-            )
-
             profile = src.profile.copy()
             profile.update({
                 'transform': new_transform,
@@ -275,13 +419,11 @@ def resampleRaster(dataset_id, reference_raster):
                 'height': new_height,
                 'crs': src_crs,
             })
-            print(f"Resampled data shape: {data.shape}")
 
-        # Save to temp
-        temp_path = input_raster.replace(".tif", "_resampled.tif")
-        with rasterio.open(temp_path, 'w', **profile) as dst:
-            dst.write(data)
-        print(f"Created temporary resampled raster: {temp_path}")
+            # Resample window by window into a temp file
+            temp_path = input_raster.replace(".tif", "_resampled.tif")
+            resample_raster(src, temp_path, profile, resampling=Resampling.bilinear)
+            print(f"Created temporary resampled raster: {temp_path} ({src.count}, {new_height}, {new_width})")
 
         # Replace original
         if os.path.exists(input_raster):
@@ -305,6 +447,7 @@ def resampleRaster(dataset_id, reference_raster):
         relative_path = input_raster.split('geospatial_datasets\\')[-1]
         dataset.task_message = f"Resampled raster to: {relative_path}"
         dataset.save()
+        refresh_band_statistics(dataset)
         print(f"Dataset updated: Status={dataset.status}, Message={dataset.task_message}")
 
         return dataset.task_message
@@ -318,75 +461,169 @@ def resampleRaster(dataset_id, reference_raster):
         return error_message
 
 
+#project grid: every raster of a project is warped onto one grid so the CNN inputs stack
+def project_grid(project):
+    if not project.grid_transform or not project.grid_width or not project.grid_height:
+        return None
+    return {
+        'crs': project.target_crs or TARGET_CRS,
+        'transform': Affine(*project.grid_transform[:6]),
+        'width': project.grid_width,
+        'height': project.grid_height,
+    }
+
+# Grid resolution used when a project grid has to be defined without a reference raster:
+# about 100 m, in degrees for geographic target CRSs
+DEFAULT_GRID_RESOLUTION = {'geographic': 0.0009, 'projected': 100.0}
+
+def ensure_project_grid(project, reference_path=None, bounds=None, bounds_crs=None):
+    """The project grid, defined on first use when the project has none yet.
+
+    The grid covers the project boundary, or else the reference raster's extent (or
+    `bounds` in `bounds_crs` when there is no reference raster), in the target CRS. Its
+    resolution is the reference raster's, or DEFAULT_GRID_RESOLUTION, and its edges
+    are snapped to whole pixels.
+    """
+    with transaction.atomic():
+        project = prospectivityProject.objects.select_for_update().get(id=project.id)
+        grid = project_grid(project)
+        if grid:
+            return grid
+        target_crs = project.target_crs or TARGET_CRS
+        if reference_path:
+            with rasterio.open(reference_path) as src:
+                transform, _, _ = calculate_default_transform(src.crs, target_crs, src.width, src.height, *src.bounds)
+                bounds = transform_bounds(src.crs, target_crs, *src.bounds)
+            resolution = (transform.a, -transform.e)
+        else:
+            bounds = transform_bounds(bounds_crs, target_crs, *bounds)
+            pixel_size = DEFAULT_GRID_RESOLUTION['projected' if metres_per_unit(target_crs) else 'geographic']
+            resolution = (pixel_size, pixel_size)
+        if project.boundary:
+            bounds = transform_bounds(f"EPSG:{project.boundary.srid or 4326}", target_crs, *project.boundary.extent)
+        transform, width, height = snapped_grid(bounds, resolution)
+        project.grid_transform = list(transform)[:6]
+        project.grid_width = width
+        project.grid_height = height
+        project.save(update_fields=['grid_transform', 'grid_width', 'grid_height'])
+        print(f"Defined project grid for {project.name}: {width}x{height} in {target_crs}")
+        return project_grid(project)
+
+@shared_task
+def alignToProjectGrid(dataset_id, resampling="bilinear"):
+    # Reprojection, resampling and grid snapping in a single warp
+    print(f"Starting alignment to project grid for dataset ID: {dataset_id}, Resampling: {resampling}")
+    try:
+        dataset = geospatialDatasets.objects.select_related('project').get(id=dataset_id)
+        if dataset.dataset_types.lower() != "raster":
+            raise ValueError("Only raster datasets can be aligned; vectors are rasterised by the proximity task")
+        input_path = dataset.file.path
+        grid = ensure_project_grid(dataset.project, input_path)
+
+        with rasterio.open(input_path) as src:
+            aligned = (crs_equivalent(src.crs, grid['crs'])
+                       and src.transform.almost_equals(grid['transform'])
+                       and (src.width, src.height) == (grid['width'], grid['height']))
+        if aligned:
+            dataset.status = "Ready"
+            dataset.task_message = "Already on the project grid, no warp needed"
+            dataset.save()
+            print(f"Dataset updated: Status={dataset.status}, Message={dataset.task_message}")
+            return dataset.task_message
+
+        temp_path = input_path.replace(".tif", "_aligned.tif")
+        warp_to_grid(
+            input_path, temp_path, grid['crs'], grid['transform'], grid['width'], grid['height'],
+            resampling=Resampling[resampling],
+            num_threads=getattr(settings, 'WARP_THREADS', None),
+            warp_mem_limit=getattr(settings, 'WARP_MEM_LIMIT', None),
+        )
+        print(f"Created temporary aligned raster: {temp_path}")
+
+        for attempt in range(5):
+            try:
+                os.replace(temp_path, input_path)
+                print(f"Renamed aligned file to original name: {input_path}")
+                break
+            except PermissionError as e:
+                if attempt == 4:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise e
+                print(f"Permission error on attempt {attempt + 1}, retrying...")
+                time.sleep(1)
+
+        dataset.status = "Ready"
+        dataset.task_message = f"Aligned to project grid {grid['width']}x{grid['height']} in {grid['crs']}"
+        dataset.save()
+        refresh_band_statistics(dataset)
+        print(f"Dataset updated: Status={dataset.status}, Message={dataset.task_message}")
+        return dataset.task_message
+
+    except Exception as e:
+        error_message = f"Error in alignToProjectGrid: {str(e)}"
+        print(error_message)
+        geospatialDatasets.objects.filter(id=dataset_id).update(status="Failed", task_message=error_message)
+        return error_message
+
+
 #proximity
 @shared_task
-def proximity_to_vector_task(vector_id, vector_path, temp_dir=None):
+def proximity_to_vector_task(vector_id, vector_path=None, temp_dir=None, max_distance=None):
+    # vector_path defaults to the dataset's FlatGeobuf, or the layer in its uploaded file
     print(f"Starting proximity task for vector_id: {vector_id}")
+    # Distances beyond the cap (in metres) are clipped, which keeps the halo of each tile small
+    if max_distance is None:
+        max_distance = getattr(settings, 'PROXIMITY_MAX_DISTANCE', None)
     try:
         # Fetch vector dataset
         with transaction.atomic():
             vector = geospatialDatasets.objects.select_for_update().get(id=vector_id)
             project = vector.project  # Assuming project is a related field
+            vector_path = vector_path or dataset_vector_path(vector)
 
         print(f"Vector path: {vector_path}")
 
-        # Read vector data
-        gdf = gpd.read_file(vector_path)
+        # Read vector data; once the project grid exists, only the features within
+        # max_distance of it can change a cell, so the rest are not read at all
+        grid = project_grid(project)
+        if grid is not None and max_distance is not None:
+            margin = grid_distance(max_distance, grid['crs']) / (metres_per_unit(grid['crs']) or 1.0)
+            left, top = grid['transform'] * (0, 0)
+            right, bottom = grid['transform'] * (grid['width'], grid['height'])
+            gdf = read_vector(vector_path, (left - margin, bottom - margin, right + margin, top + margin),
+                              grid['crs'])
+        else:
+            gdf = gpd.read_file(vector_path)
         print(f"Vector CRS: {gdf.crs}")
+        if gdf.crs is None:
+            gdf = gdf.set_crs('EPSG:4326')  # Default to WGS84 if CRS is None
 
-        # Calculate raster extent from vector bounds
-        bounds = gdf.total_bounds  # [minx, miny, maxx, maxy]
-        extent_width = bounds[2] - bounds[0]
-        extent_height = bounds[3] - bounds[1]
-        print(f"Vector bounds: {bounds}, Extent: Width={extent_width}, Height={extent_height}")
-
-        # Define raster resolution (adjustable, default to ~100m at equator for EPSG:4326)
-        pixel_size = 0.0009  # Approx. 100m, configurable as needed
-        width = int(np.ceil(extent_width / pixel_size))
-        height = int(np.ceil(extent_height / pixel_size))
-        print(f"Calculated raster dimensions: (height={height}, width={width})")
-
-        # Validate dimensions
-        if width <= 0 or height <= 0:
-            raise ValueError(f"Calculated dimensions ({height}, {width}) are invalid (<= 0). Check pixel size and bounds.")
-        if width > 100000 or height > 100000:
-            raise ValueError(f"Calculated dimensions ({height}, {width}) are too large. Check pixel size.")
-
-        # Create transform
-        transform = rasterio.transform.from_origin(bounds[0], bounds[3], pixel_size, -pixel_size)
-
-        # Rasterize vector to binary raster
-        shapes = [(geom, 1) for geom in gdf.geometry if geom is not None and not geom.is_empty]
-        if not shapes:
+        # A capped raster can be all cap on an existing grid; anything else needs features,
+        # and a new grid cannot be built from the bounds of an empty layer
+        gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+        if gdf.empty and (grid is None or max_distance is None):
             raise ValueError("No valid geometries found in vector file")
-        binary_raster = rasterize(
-            shapes,
-            out_shape=(height, width),
-            transform=transform,
-            fill=0,
-            dtype='uint8'
-        )
-        print(f"Binary raster created with shape: {binary_raster.shape}")
-
-        # Calculate distance transform
-        distance = distance_transform_edt(binary_raster == 0) * pixel_size
-        print(f"Distance transform calculated with shape: {distance.shape}")
-
-        # Create temporary proximity raster
-        temp_path = vector_path.replace(".shp", "_proximity.tif")
-        meta = {
-            'driver': 'GTiff',
-            'height': height,
-            'width': width,
-            'count': 1,
-            'dtype': 'float32',
-            'crs': gdf.crs.to_string() if gdf.crs else 'EPSG:4326',  # Default to WGS84 if CRS is None
-            'transform': transform,
-            'nodata': None
-        }
-        with rasterio.open(temp_path, 'w', **meta) as dst:
-            dst.write(distance.astype(np.float32), 1)
-        print(f"Created temporary proximity raster: {temp_path}")
+
+        # Compute on the project grid so the raster stacks with the project's other layers
+        reference = (geospatialDatasets.objects.filter(project=project, dataset_types__iexact="raster")
+                     .exclude(id=vector_id).first())
+        grid = ensure_project_grid(project, reference.file.path if reference else None,
+                                   bounds=gdf.total_bounds, bounds_crs=gdf.crs.to_wkt())
+        gdf = gdf.to_crs(grid['crs'])
+        print(f"Project grid: {grid['width']}x{grid['height']} in {grid['crs']}")
+
+        geometries = list(gdf.geometry)
+
+        # Distances in metres on projected grids, in degrees on geographic ones
+        unit_scale = metres_per_unit(grid['crs']) or 1.0
+
+        # Rasterize and compute distances tile by tile into a temporary proximity raster
+        temp_path = f"{os.path.splitext(vector.file.path)[0]}_proximity.tif"
+        proximity_raster(geometries, temp_path, grid['transform'], grid['width'], grid['height'], grid['crs'],
+                         max_distance=grid_distance(max_distance, grid['crs']) if max_distance is not None else None,
+                         unit_scale=unit_scale)
+        print(f"Created temporary proximity raster: {temp_path} (max distance: {max_distance})")
 
         # Determine project folder path dynamically
         project_folder = os.path.join(settings.MEDIA_ROOT, "geospatial_datasets", project.name)
@@ -411,22 +648,26 @@ def proximity_to_vector_task(vector_id, vector_path, temp_dir=None):
                 print(f"Permission error on attempt {attempt + 1}, retrying after delay: {str(e)}")
                 time.sleep(1)
 
-        # Delete the original .zip file
+        # Delete the original .zip file and its FlatGeobuf
         original_zip_path = vector.file.path
         if os.path.exists(original_zip_path) and original_zip_path.endswith('.zip'):
             os.remove(original_zip_path)
             print(f"Deleted original zip file: {original_zip_path}")
+        if vector.processed_file and os.path.exists(vector.processed_file.path):
+            os.remove(vector.processed_file.path)
 
         # Update dataset
         with transaction.atomic():
             vector = geospatialDatasets.objects.select_for_update().get(id=vector_id)
             # Update file reference to the new location relative to MEDIA_ROOT
             vector.file.name = os.path.relpath(final_path, settings.MEDIA_ROOT).replace("\\", "/")
+            vector.processed_file = None
             vector.dataset_types = "raster"
             vector.status = "Ready"
             vector.task_message = f"Proximity raster generated: {final_path}"
             vector.save()
             print(f"Dataset updated: Status={vector.status}, Message={vector.task_message}")
+        refresh_band_statistics(vector)
 
         # Clean up temporary directory if used
         if temp_dir and os.path.exists(temp_dir):
@@ -442,4 +683,177 @@ def proximity_to_vector_task(vector_id, vector_path, temp_dir=None):
             vector.status = "Failed"
             vector.task_message = error_message
             vector.save()
-        return error_message
\ No newline at end of file
+        return error_message
+
+
+#ingest: every uploaded raster is rewritten as a COG (tiled, compressed, internal overviews)
+#so the later stages read tiles and overviews instead of whole strips
+def original_upload_path(path):
+    # Where the untouched upload is kept when settings.KEEP_ORIGINAL_UPLOADS is on
+    return os.path.join(os.path.dirname(path), "originals", os.path.basename(path))
+
+@shared_task
+def convertToCOG(dataset_id):
+    dataset = geospatialDatasets.objects.get(id=dataset_id)
+    if dataset.dataset_types.lower() != "raster":
+        return None
+    input_path = dataset.file.path
+    try:
+        with rasterio.open(input_path) as src:
+            if is_cog_layout(src):
+                print(f"Dataset {dataset_id} is already a COG")
+                return None
+            # Classes and flags keep nearest-neighbour overviews
+            overview_resampling = Resampling.average if src.dtypes[0].startswith('float') else Resampling.nearest
+        source_stat = os.stat(input_path)
+        temp_path = f"{os.path.splitext(input_path)[0]}_cog.tif"
+        convert_to_cog(input_path, temp_path, overview_resampling)
+
+        # A preprocessing task may have rewritten the file meanwhile; its output wins
+        dataset.refresh_from_db()
+        stat = os.stat(input_path) if os.path.exists(input_path) else None
+        if dataset.file.path != input_path or stat is None or \
+                (stat.st_ino, stat.st_mtime_ns) != (source_stat.st_ino, source_stat.st_mtime_ns):
+            os.remove(temp_path)
+            print(f"Dataset {dataset_id} changed during COG conversion, conversion discarded")
+            return None
+
+        if getattr(settings, 'KEEP_ORIGINAL_UPLOADS', False):
+            original_path = original_upload_path(input_path)
+            os.makedirs(os.path.dirname(original_path), exist_ok=True)
+            os.replace(input_path, original_path)
+            print(f"Kept original upload: {original_path}")
+        os.replace(temp_path, input_path)
+        # Pixel values are unchanged, so the stored statistics still hold
+        print(f"Converted dataset {dataset_id} to COG: {input_path}")
+        return input_path
+    except Exception as e:
+        # The upload stays usable in its original layout; later steps still run
+        print(f"Error in convertToCOG for dataset {dataset_id}: {e}")
+        if os.path.exists(f"{os.path.splitext(input_path)[0]}_cog.tif"):
+            os.remove(f"{os.path.splitext(input_path)[0]}_cog.tif")
+        return None
+
+@shared_task
+def convertToFlatGeobuf(dataset_id):
+    # Parse the uploaded layer once into a FlatGeobuf; every later read is a bbox query on its index
+    dataset = geospatialDatasets.objects.get(id=dataset_id)
+    if dataset.dataset_types.lower() != "vector":
+        return None
+    input_path = dataset.file.path
+    output_path = f"{os.path.splitext(input_path)[0]}.fgb"
+    # The FlatGeobuf driver needs the .fgb extension on the file it creates
+    temp_path = f"{os.path.splitext(input_path)[0]}_tmp.fgb"
+    try:
+        dropped = convert_to_flatgeobuf(input_path, temp_path)
+        if dropped:
+            logger.warning("Dropped %d features without geometry from dataset %s", dropped, dataset_id)
+        # The proximity task may have turned the dataset into a raster meanwhile, or
+        # crsHarmonization already written a reprojected FlatGeobuf
+        dataset.refresh_from_db()
+        if dataset.dataset_types.lower() != "vector" or dataset.processed_file:
+            os.remove(temp_path)
+            return None
+        os.replace(temp_path, output_path)
+        geospatialDatasets.objects.filter(id=dataset_id).update(
+            processed_file=os.path.relpath(output_path, settings.MEDIA_ROOT).replace("\\", "/"))
+        print(f"Converted dataset {dataset_id} to FlatGeobuf: {output_path}")
+        return output_path
+    except Exception as e:
+        # Readers fall back to the uploaded layer
+        logger.warning("convertToFlatGeobuf failed for dataset %s, readers fall back to the uploaded layer: %s",
+                       dataset_id, e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return None
+
+@shared_task
+def computeFileHash(dataset_id):
+    # sha256 of uploads that were not hashed while they streamed in (chunked uploads arrive out of order)
+    dataset = geospatialDatasets.objects.get(id=dataset_id)
+    file_hash = file_sha256(dataset.file.path)
+    geospatialDatasets.objects.filter(id=dataset_id).update(file_hash=file_hash)
+    return file_hash
+
+def ingest_dataset(dataset):
+    # Background ingest of a new upload. The hash comes first, as the conversions rewrite the file;
+    # rasters become COGs before the thumbnail and exact statistics, so those read the tiled file
+    steps = [] if dataset.file_hash else [computeFileHash.si(dataset.id)]
+    if dataset.dataset_types.lower() == "raster":
+        steps += [convertToCOG.si(dataset.id), generateThumbnail.si(dataset.id), computeBandStatistics.si(dataset.id)]
+    else:
+        steps.append(convertToFlatGeobuf.si(dataset.id))
+    return chain(*steps).delay()
+
+
+#thumbnails
+@shared_task
+def generateThumbnail(dataset_id):
+    dataset = geospatialDatasets.objects.get(id=dataset_id)
+    if dataset.dataset_types.lower() != 'raster':
+        return None
+    thumbnail_dir = os.path.join(settings.MEDIA_ROOT, 'thumbnails')
+    os.makedirs(thumbnail_dir, exist_ok=True)  # Create thumbnails directory if it doesn't exist
+    thumbnail_path = os.path.join(thumbnail_dir, f'{dataset.id}.png')
+    with rasterio.open(dataset.file.path) as src:
+        # Decimated read, served from overviews when the file has them
+        scale = max(1.0, max(src.width, src.height) / 512)
+        data = src.read(1, out_shape=(max(1, int(src.height / scale)), max(1, int(src.width / scale))), masked=True)
+    # Stretch between the stored 2nd and 98th percentiles; nodata stays transparent
+    stats = ((dataset.band_statistics or {}).get('bands') or [{}])[0]
+    percentiles = stats.get('percentiles') or {}
+    vmin = percentiles.get('p2', data.min() if data.count() else 0)
+    vmax = percentiles.get('p98', data.max() if data.count() else 1)
+    plt.imsave(thumbnail_path, data, cmap='viridis', vmin=vmin, vmax=vmax)
+    dataset.thumbnail = f'thumbnails/{dataset.id}.png'
+    dataset.save(update_fields=['thumbnail'])
+    return dataset.thumbnail.name
+
+
+#project pipeline: every dataset is prepared in parallel, then the CNN runs on the result
+def dataset_pipeline(dataset):
+    # Chain bringing one dataset onto the project grid and drawing its thumbnail.
+    # Rasters are reprojected, resampled and snapped in one warp; vectors become proximity rasters.
+    if dataset.dataset_types.lower() == "vector":
+        prepare = proximity_to_vector_task.si(dataset.id)
+    else:
+        prepare = alignToProjectGrid.si(dataset.id)
+    return prepare | generateThumbnail.si(dataset.id)
+
+def dispatch_project_pipeline(project, modelRun):
+    datasets = list(geospatialDatasets.objects.filter(project=project))
+    geospatialDatasets.objects.filter(project=project).update(status="Preprocessing",
+                                                             task_message="Queued in project pipeline")
+    finish = projectPipelineComplete.s(project.id, modelRun.id)
+    finish.on_error(project_pipeline_failed.s(modelRun.id))
+
+    modelRun.task_message = f"Preprocessing {len(datasets)} datasets"
+    modelRun.save(update_fields=['task_message'])
+    print(modelRun.task_message)
+    chord(group([dataset_pipeline(dataset) for dataset in datasets]))(finish)
+    return modelRun.task_message
+
+@shared_task
+def projectPipelineComplete(results, project_id, modelRunId):
+    # Chord callback: start the prediction once every dataset of the project is Ready
+    modelRun = MLmodelRun.objects.get(id=modelRunId)
+    datasets = geospatialDatasets.objects.filter(project_id=project_id)
+    not_ready = [dataset.dataset_names for dataset in datasets if dataset.status != "Ready"]
+    if not_ready:
+        modelRun.status = "Failed"
+        modelRun.task_message = f"Preprocessing failed for: {', '.join(not_ready)}"
+        modelRun.save()
+        print(modelRun.task_message)
+        return modelRun.task_message
+
+    modelRun.input_data.set(datasets.filter(dataset_types__iexact="raster"))
+    modelRun.task_message = "Preprocessing complete, queued for prediction"
+    modelRun.save(update_fields=['task_message'])
+    MLmodelRunTask.delay(modelRun.id)
+    return modelRun.task_message
+
+@shared_task
+def project_pipeline_failed(request, exc, traceback, modelRunId):
+    # Error callback of the pipeline chord: a preprocessing step raised
+    print(f"Project pipeline failed for model run {modelRunId}: {exc}")
+    MLmodelRun.objects.filter(id=modelRunId).update(status="Failed", task_message=f"Preprocessing failed: {exc}")
@@ -0,0 +1,150 @@
+import os
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_origin
+from django.test import SimpleTestCase
+from prospectivity.model_ML import (load_and_combine_tif_files, load_patch_validity, predict_windowed,
+                                    reconstruct_prediction_map, prepare_prediction_grid, predict_patch_rows,
+                                    merge_tiled_predictions, PROBABILITY_NODATA)
+
+# Small patches keep the rasters tiny; every function takes the patch size as a parameter
+PATCH_SIZE = 16
+NODATA = -9999.0
+
+
+class MeanModel:
+    """Stand-in for the CNN: a weighted mean of each patch's channels."""
+    name = 'mean'
+    weights = np.array([0.2, 0.3, 0.5], dtype=np.float32)
+
+    def predict_on_batch(self, patches):
+        return (patches.mean(axis=(1, 2)) @ self.weights)[:, np.newaxis]
+
+    def predict(self, patches, batch_size=16):
+        return self.predict_on_batch(patches)
+
+
+def write_raster(path, data, nodata=None):
+    count, height, width = data.shape
+    with rasterio.open(path, 'w', driver='GTiff', width=width, height=height, count=count, dtype=data.dtype,
+                       crs='EPSG:32755', transform=from_origin(500000, 7000000, 10, 10), nodata=nodata) as dst:
+        dst.write(data)
+    return path
+
+
+def dense_predictions(model, tif_paths, patch_size=PATCH_SIZE):
+    # The in-memory path of load_and_generate_predictions
+    patches, shape, patch_coords, *_ = load_and_combine_tif_files(tif_paths, patch_size)
+    valid = load_patch_validity(tif_paths, patch_size).reshape(-1)
+    probabilities = np.full((len(patches), 1), np.nan, dtype=np.float32)
+    probabilities[valid] = model.predict(patches[valid])
+    return probabilities, reconstruct_prediction_map(probabilities, shape, patch_coords, patch_size)
+
+
+class RasterTestCase(SimpleTestCase):
+    """A single-band raster with nodata patches and a three-band one, both with an edge remainder."""
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp_dir = tmp.name
+        rng = np.random.default_rng(0)
+        height, width = 5 * PATCH_SIZE + 3, 7 * PATCH_SIZE + 5
+        single = (rng.random((1, height, width)) * 100).astype(np.float32)
+        single[0, :PATCH_SIZE, :2 * PATCH_SIZE] = NODATA
+        single[0, 3 * PATCH_SIZE:4 * PATCH_SIZE, 5 * PATCH_SIZE:6 * PATCH_SIZE] = NODATA
+        self.single = write_raster(os.path.join(self.tmp_dir, 'single.tif'), single, nodata=NODATA)
+        self.three = write_raster(os.path.join(self.tmp_dir, 'three.tif'),
+                                  rng.integers(0, 200, (3, height, width)).astype(np.uint8))
+
+
+class PatchGridTests(RasterTestCase):
+
+    def test_patches_are_normalised_raster_blocks(self):
+        patches, shape, patch_coords, *_ = load_and_combine_tif_files([self.three], PATCH_SIZE)
+        with rasterio.open(self.three) as src:
+            bands = src.read().astype(np.float32)
+        # Normalised with each band's full extent, edge remainder included
+        lo, hi = bands.min(axis=(1, 2)), bands.max(axis=(1, 2))
+        expected = (bands - lo[:, None, None]) / (hi - lo)[:, None, None]
+        self.assertEqual(patches.shape, (35, PATCH_SIZE, PATCH_SIZE, 3))
+        self.assertEqual(patch_coords[:3].tolist(), [[0, 0], [0, PATCH_SIZE], [0, 2 * PATCH_SIZE]])
+        for patch, (row, col) in zip(patches, patch_coords):
+            block = expected[:, row:row + PATCH_SIZE, col:col + PATCH_SIZE]
+            np.testing.assert_allclose(patch, block.transpose(1, 2, 0), atol=1e-6)
+
+    def test_reconstruction_is_the_inverse_of_extraction(self):
+        patches, shape, patch_coords, *_ = load_and_combine_tif_files([self.three], PATCH_SIZE)
+        predictions = np.arange(len(patches), dtype=np.float32)
+        predictions[4] = np.nan
+        prediction_map = reconstruct_prediction_map(predictions, shape, patch_coords, PATCH_SIZE)
+        self.assertEqual(prediction_map.shape, shape)
+        for value, (row, col) in zip(predictions, patch_coords):
+            block = prediction_map[row:row + PATCH_SIZE, col:col + PATCH_SIZE]
+            self.assertTrue((block == (PROBABILITY_NODATA if np.isnan(value) else value)).all())
+        # The edge remainder holds no patch
+        self.assertTrue((prediction_map[5 * PATCH_SIZE:] == PROBABILITY_NODATA).all())
+        self.assertTrue((prediction_map[:, 7 * PATCH_SIZE:] == PROBABILITY_NODATA).all())
+
+
+class StreamingPredictionTests(RasterTestCase):
+
+    def predict_streaming(self, tif_paths):
+        prob_map_path = os.path.join(self.tmp_dir, 'probability_map.tif')
+        probabilities, *_ = predict_windowed(MeanModel(), tif_paths, prob_map_path, patch_size=PATCH_SIZE,
+                                             batch_size=4)
+        with rasterio.open(prob_map_path) as src:
+            return probabilities, src.read(1)
+
+    def assert_streaming_matches_dense(self, tif_paths):
+        expected, expected_map = dense_predictions(MeanModel(), tif_paths)
+        probabilities, prob_map = self.predict_streaming(tif_paths)
+        np.testing.assert_allclose(probabilities, expected, atol=1e-6)
+        np.testing.assert_allclose(prob_map, expected_map, atol=1e-6)
+
+    def test_single_band_raster(self):
+        self.assert_streaming_matches_dense([self.single])
+
+    def test_three_band_raster(self):
+        self.assert_streaming_matches_dense([self.three])
+
+    def test_raster_repeated_across_channels(self):
+        self.assert_streaming_matches_dense([self.single, self.single, self.single])
+
+    def test_nodata_patches_are_not_predicted(self):
+        probabilities, prob_map = self.predict_streaming([self.single])
+        self.assertEqual(np.isnan(probabilities).sum(), 3)
+        self.assertTrue((prob_map[:PATCH_SIZE, :2 * PATCH_SIZE] == PROBABILITY_NODATA).all())
+
+
+@mock.patch('prospectivity.model_ML.get_inference_engine', return_value=MeanModel())
+class TiledPredictionTests(RasterTestCase):
+
+    def predict_tiled(self, tif_paths, tile_rows=2):
+        # What MLmodelRunTask's chord does: tiles of patch rows saved as .npy, then one merge
+        grid = prepare_prediction_grid(tif_paths, PATCH_SIZE)
+        output_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        tiles = []
+        for row_start in range(0, grid['n_patch_rows'], tile_rows):
+            row_stop = min(row_start + tile_rows, grid['n_patch_rows'])
+            probabilities = predict_patch_rows(tif_paths, row_start, row_stop, grid['band_stats'], PATCH_SIZE,
+                                               batch_size=4)
+            tile_path = os.path.join(output_dir, f"tile_{row_start:06d}.npy")
+            np.save(tile_path, probabilities)
+            tiles.append([row_start, tile_path])
+        return merge_tiled_predictions(tif_paths, tiles, output_dir, PATCH_SIZE)
+
+    def test_merged_tiles_match_dense(self, get_inference_engine):
+        for tif_paths in ([self.single], [self.three], [self.single, self.three]):
+            with self.subTest(tif_paths=[os.path.basename(path) for path in tif_paths]):
+                expected, expected_map = dense_predictions(MeanModel(), tif_paths)
+                result = self.predict_tiled(tif_paths)
+                self.assertEqual(result['metrics']['tiles'], 3)
+                with rasterio.open(result['outputs']['probability_map']) as src:
+                    np.testing.assert_allclose(src.read(1), expected_map, atol=1e-6)
+                predictions = pd.read_csv(os.path.join(os.path.dirname(result['outputs']['probability_map']),
+                                                       'predictions.csv'))
+                np.testing.assert_allclose(predictions['Probability'], expected[:, 0], atol=1e-6)
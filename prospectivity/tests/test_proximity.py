@@ -0,0 +1,75 @@
+import os
+import tempfile
+import numpy as np
+import rasterio
+from rasterio.features import rasterize
+from rasterio.transform import Affine, from_origin
+from scipy.ndimage import distance_transform_edt
+from shapely.geometry import LineString, Point, box
+from django.test import SimpleTestCase
+from prospectivity.proximity import proximity_raster
+
+PIXEL_SIZE = 10.0
+WIDTH, HEIGHT = 100, 80
+TRANSFORM = from_origin(500000, 7000000, PIXEL_SIZE, PIXEL_SIZE)
+CRS = 'EPSG:32755'
+# Far enough around the grid to hold every feature below
+PAD = 60
+
+
+def pixel_point(col, row):
+    return TRANSFORM * (col, row)
+
+
+def reference_distances(geometries):
+    """Distances from one distance transform over a canvas holding the grid and every feature."""
+    canvas_transform = TRANSFORM * Affine.translation(-PAD, -PAD)
+    burned = rasterize(((geom, 1) for geom in geometries), out_shape=(HEIGHT + 2 * PAD, WIDTH + 2 * PAD),
+                       transform=canvas_transform, fill=0, dtype='uint8')
+    distance = distance_transform_edt(burned == 0, sampling=(PIXEL_SIZE, PIXEL_SIZE))
+    return distance[PAD:PAD + HEIGHT, PAD:PAD + WIDTH].astype(np.float32)
+
+
+class ProximityRasterTests(SimpleTestCase):
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dst_path = os.path.join(tmp.name, 'proximity.tif')
+        self.geometries = [
+            LineString([pixel_point(10.5, 10.5), pixel_point(40.5, 30.5)]),
+            Point(pixel_point(75.5, 60.5)),
+            # Partly and wholly outside the grid: both still set the distances of the cells near the edges
+            box(*pixel_point(90.5, 50.5), *pixel_point(120.5, 20.5)),
+            Point(pixel_point(-30.5, 70.5)),
+        ]
+
+    def proximity(self, **kwargs):
+        kwargs.setdefault('tile_size', 32)
+        proximity_raster(self.geometries, self.dst_path, TRANSFORM, WIDTH, HEIGHT, CRS, simplify=False, **kwargs)
+        with rasterio.open(self.dst_path) as src:
+            return src.read(1)
+
+    def test_capped_distances_are_exact_distances_capped(self):
+        for max_distance in (55.0, 150.0):
+            with self.subTest(max_distance=max_distance):
+                distance = self.proximity(max_distance=max_distance)
+                expected = np.minimum(reference_distances(self.geometries), max_distance)
+                np.testing.assert_allclose(distance, expected, atol=1e-3)
+
+    def test_uncapped_tiles_match_whole_grid_distances(self):
+        distance = self.proximity(max_distance=None)
+        np.testing.assert_allclose(distance, reference_distances(self.geometries), atol=1e-3)
+
+    def test_tiles_far_from_features_are_measured_without_burning(self):
+        # A canvas budget of one pixel sends every tile to the exact cell-centre distances,
+        # which differ from the burned ones by less than the pixel rasterisation error
+        distance = self.proximity(max_distance=None, max_canvas_pixels=1)
+        np.testing.assert_allclose(distance, reference_distances(self.geometries), atol=1.6 * PIXEL_SIZE)
+
+    def test_uncapped_distances_need_a_geometry(self):
+        self.geometries = []
+        with self.assertRaises(ValueError):
+            self.proximity(max_distance=None)
+        # With a cap every cell is simply beyond it
+        self.assertTrue((self.proximity(max_distance=100.0) == 100.0).all())
@@ -0,0 +1,130 @@
+#upload handler: each uploaded file is written once, into a private staging directory under MEDIA_ROOT,
+#and hashed while it streams; the storage then promotes it to its final name with a rename
+#https://docs.djangoproject.com/en/4.1/topics/http/file-uploads/#upload-handlers
+#large files come in as resumable upload sessions instead: chunks are written at their offsets
+#into the same kind of staging directory, and the assembled file is promoted the same way
+import os
+import uuid
+import shutil
+import hashlib
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from .models import UploadSession
+
+def staging_root():
+    return os.path.join(settings.MEDIA_ROOT, 'staging')
+
+class StagedUploadedFile(UploadedFile):
+    """An upload already on disk in its own staging directory.
+
+    Exposing temporary_file_path() makes FileSystemStorage move it into place with
+    os.rename (same filesystem) instead of copying it.
+    """
+    def __init__(self, path, name, content_type, charset, content_type_extra=None, mode='wb+'):
+        super().__init__(open(path, mode), name, content_type, os.path.getsize(path), charset, content_type_extra)
+        self.path = path
+        self.sha256 = None
+
+    def temporary_file_path(self):
+        return self.path
+
+    def discard(self):
+        # Drop the staging directory, whether or not the file was promoted out of it
+        self.close()
+        shutil.rmtree(os.path.dirname(self.path), ignore_errors=True)
+
+class StagingUploadHandler(FileUploadHandler):
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.staged = []
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        staging_dir = os.path.join(staging_root(), uuid.uuid4().hex)
+        os.makedirs(staging_dir)
+        path = os.path.join(staging_dir, os.path.basename(self.file_name))
+        self.file = StagedUploadedFile(path, self.file_name, self.content_type, self.charset,
+                                       self.content_type_extra)
+        self.staged.append(self.file)
+        self.hash = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.hash.update(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.flush()
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.sha256 = self.hash.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            self.file.discard()
+
+    def discard(self):
+        # Every file this request staged, including ones the view never got to see
+        for staged in self.staged:
+            staged.discard()
+
+# Bytes read from the request per write while a chunk is streamed to disk
+CHUNK_READ_SIZE = 1024 * 1024
+
+def session_file_path(session):
+    return os.path.join(staging_root(), session.id.hex, os.path.basename(session.file_name))
+
+def create_session_file(session):
+    # Full-size sparse file, so every chunk can be written at its offset as soon as it arrives
+    path = session_file_path(session)
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.truncate(session.file_size)
+    return path
+
+def chunk_length(session, offset):
+    """Size of the chunk starting at offset, or None when offset is not a chunk boundary."""
+    if offset < 0 or offset >= session.file_size or offset % session.chunk_size:
+        return None
+    return min(session.chunk_size, session.file_size - offset)
+
+def missing_chunks(session):
+    return [offset for offset in range(0, session.file_size, session.chunk_size)
+            if str(offset) not in session.received_chunks]
+
+def read_chunk(stream, length):
+    """Read a chunk body of length bytes from stream; returns the bytes and their sha256."""
+    sha = hashlib.sha256()
+    data = bytearray()
+    while len(data) < length:
+        piece = stream.read(min(CHUNK_READ_SIZE, length - len(data)))
+        if not piece:
+            raise ValueError(f"Chunk ended after {len(data)} of {length} bytes")
+        data += piece
+        sha.update(piece)
+    return data, sha.hexdigest()
+
+def write_chunk(session, offset, data):
+    """Write a verified chunk into the session file at offset."""
+    with open(session_file_path(session), 'r+b') as f:
+        f.seek(offset)
+        f.write(data)
+
+def discard_session(session):
+    shutil.rmtree(os.path.dirname(session_file_path(session)), ignore_errors=True)
+
+def expire_upload_sessions(max_age=None):
+    """Drop sessions left unfinished for longer than max_age seconds, with their partial files.
+
+    Assembling sessions are included: one that old had its completion request die midway.
+    """
+    max_age = max_age if max_age is not None else getattr(settings, 'UPLOAD_SESSION_MAX_AGE', 2 * 24 * 3600)
+    stale = UploadSession.objects.filter(status__in=["Open", "Assembling", "Failed"],
+                                         updated_on__lt=timezone.now() - timedelta(seconds=max_age))
+    for session in stale:
+        discard_session(session)
+        print(f"Expired upload session {session.id} ({session.file_name})")
+    stale.delete()
@@ -14,16 +14,26 @@ urlpatterns = [
     path('project/create/', views.project_create, name='project_create'),
     path('project/<int:project_id>/', views.project_detail, name='project_detail'),
     path('project/<int:project_id>/dataset/upload/', views.dataset_upload, name='dataset_upload'),
+    path('project/<int:project_id>/upload-session/', views.upload_session_create, name='upload_session_create'),
+    path('upload-session/<uuid:session_id>/', views.upload_session_status, name='upload_session_status'),
+    path('upload-session/<uuid:session_id>/chunk/<int:offset>/', views.upload_session_chunk,
+         name='upload_session_chunk'),
+    path('upload-session/<uuid:session_id>/complete/', views.upload_session_complete,
+         name='upload_session_complete'),
     path('project/delete/<int:project_id>/', views.project_delete, name='project_delete'),
     path('map/', views.map_view, name='map'),
     path('help/', views.help_view, name='help'),
 
     path('trigger_crs/<int:dataset_id>/', views.trigger_crs, name='trigger_crs'),
     path('trigger_resample/<int:dataset_id>/', views.trigger_resample, name='trigger_resample'),
+    path('trigger_align/<int:dataset_id>/', views.trigger_align, name='trigger_align'),
     path('trigger_proximity/<int:dataset_id>/', views.trigger_proximity, name='trigger_proximity'),
     path('status/<int:dataset_id>/', views.status_view, name='status_view'),
+    path('project/<int:project_id>/pipeline/', views.run_project_pipeline, name='project_pipeline'),
     path('select-datasets/<int:project_id>/', views.select_and_predict_datasets, 
          name='select_and_predict_datasets'),
+    path('prediction-status/<int:run_id>/', views.prediction_status_view,
+         name='prediction_status'),
     path('download-csv/<int:project_id>/', views.download_predictions_csv, 
          name='download_predictions_csv'),
  ] #+ static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
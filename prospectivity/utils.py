@@ -1,9 +1,34 @@
 #validating data and storing metadata to geospatial dataset model
 import os
+import zipfile
+from itertools import islice
+import numpy as np
+import fiona
+import shapely
+from shapely.geometry import shape, mapping
 import rasterio
+from rasterio.windows import Window
+from rasterio.warp import transform_bounds
+from pyproj import CRS, Transformer
 import geopandas as gpd
 from .models import geospatialDatasets
 
+# Percentiles stored with every band's statistics
+STAT_PERCENTILES = (2, 25, 50, 75, 98)
+
+# Vector formats read from inside zip archives, in order of preference
+VECTOR_LAYER_EXTENSIONS = ('.shp', '.gpkg', '.geojson', '.json', '.fgb')
+
+# Features sampled for geometry types when the layer definition does not name one
+GEOMETRY_TYPE_SAMPLE = 1000
+
+# Features copied (and reprojected) per batch when a vector layer is converted to FlatGeobuf;
+# memory stays proportional to the batch whatever the size of the layer
+VECTOR_BATCH_SIZE = 10000
+
+# Single-part layer types that routinely hold multi-part features as well (shapefiles do not tell them apart)
+MULTI_GEOMETRY_TYPES = {'Point': 'MultiPoint', 'LineString': 'MultiLineString', 'Polygon': 'MultiPolygon'}
+
 def file_validation(dataset_upload_path):
     extension = os.path.splitext(dataset_upload_path)[1].lower()
 
@@ -26,15 +51,186 @@ def validate_raster(dataset_upload_path):
 
 
 def validate_vector(dataset_upload_path):
-    gdf= gpd.read_file(dataset_upload_path)     #GeoDataFrame
-    geometry_types = list(gdf.geometry.type.unique())
-    return{
-        "dataset_types":"vector",
-        "crs": str(gdf.crs),
-        "band_info": None,
-        "geometry_types": ",".join(geometry_types)
+    return vector_metadata(dataset_upload_path)
+
+def vector_layer_path(dataset_path):
+    """GDAL path of the vector layer in a dataset file; zip archives are read in place through /vsizip/."""
+    if not dataset_path.lower().endswith('.zip'):
+        return dataset_path
+    with zipfile.ZipFile(dataset_path) as archive:
+        members = [name for name in archive.namelist() if not name.startswith('__MACOSX/')]
+    for extension in VECTOR_LAYER_EXTENSIONS:
+        for name in members:
+            if name.lower().endswith(extension):
+                return f"/vsizip/{os.path.abspath(dataset_path)}/{name}".replace("\\", "/")
+    raise ValueError("No shapefile, GeoPackage or GeoJSON found in zip archive")
+
+def vector_metadata(dataset_path):
+    """Validate a vector dataset from its layer metadata only: schema, CRS, feature count and extent.
+
+    Geometry types come from the layer definition, or from the first
+    GEOMETRY_TYPE_SAMPLE features when the format does not declare one.
+    """
+    with fiona.open(vector_layer_path(dataset_path)) as src:
+        geometry_type = src.schema.get('geometry')
+        if geometry_type in (None, 'Unknown', 'Any', 'GeometryCollection'):
+            geometry_types = sorted({feature['geometry']['type'] for feature in islice(src, GEOMETRY_TYPE_SAMPLE)
+                                     if feature['geometry'] is not None})
+        else:
+            geometry_types = [geometry_type]
+        crs = CRS.from_wkt(src.crs_wkt).to_string() if src.crs_wkt else None
+        return {
+            "dataset_types": "vector",
+            "crs": crs,
+            "band_info": None,
+            "geometry_types": ",".join(geometry_types),
+            "feature_count": len(src),
+            "extent": list(src.bounds),
+            "fields": dict(src.schema['properties']),
+        }
+
+def convert_to_flatgeobuf(dataset_path, dst_path, dst_crs=None, batch_size=VECTOR_BATCH_SIZE):
+    """Copy the vector layer of a dataset file into a FlatGeobuf with a packed R-tree, batch_size features at a time.
+
+    With dst_crs the features are reprojected on the way: the coordinates of a whole
+    batch go through pyproj as one array. Features with a null or empty geometry are
+    left out, as the spatial index cannot hold them; returns how many were dropped.
+    """
+    with fiona.open(vector_layer_path(dataset_path)) as src:
+        if dst_crs is not None and not src.crs:
+            raise ValueError("Vector layer has no CRS to reproject from")
+        schema = dict(src.schema)
+        if schema['geometry'] in MULTI_GEOMETRY_TYPES:
+            schema['geometry'] = (schema['geometry'], MULTI_GEOMETRY_TYPES[schema['geometry']])
+        crs = src.crs
+        if dst_crs is not None:
+            crs = CRS.from_user_input(dst_crs).to_wkt()
+            transformer = Transformer.from_crs(src.crs_wkt, crs, always_xy=True)
+        dropped = 0
+        with fiona.open(dst_path, 'w', driver='FlatGeobuf', schema=schema, crs=crs, SPATIAL_INDEX='YES') as dst:
+            features = iter(src)
+            while True:
+                batch = list(islice(features, batch_size))
+                if not batch:
+                    break
+                geometries = np.array([shape(feature.geometry) if feature.geometry else None for feature in batch],
+                                      dtype=object)
+                # Null and empty geometries cannot affect proximity, so skipping them loses nothing
+                keep = ~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)
+                dropped += len(batch) - int(keep.sum())
+                batch = [feature for feature, kept in zip(batch, keep) if kept]
+                if dst_crs is not None:
+                    geometries = shapely.transform(geometries[keep], transformer.transform, interleaved=False)
+                    batch = [{'geometry': mapping(geometry), 'properties': dict(feature.properties)}
+                             for feature, geometry in zip(batch, geometries)]
+                if batch:
+                    dst.writerecords(batch)
+        return dropped
+
+def dataset_vector_path(dataset):
+    # The FlatGeobuf made at ingest when there is one, otherwise the layer inside the uploaded file
+    if dataset.processed_file and os.path.exists(dataset.processed_file.path):
+        return dataset.processed_file.path
+    return vector_layer_path(dataset.file.path)
+
+def read_vector(layer_path, bounds=None, bounds_crs=None):
+    """GeoDataFrame of a vector layer, limited to the features intersecting `bounds` (in bounds_crs) when given.
+
+    On FlatGeobuf and GeoPackage layers the bbox filter is answered from the
+    spatial index, so features outside it are never parsed.
+    """
+    if bounds is None:
+        return gpd.read_file(layer_path)
+    with fiona.open(layer_path) as src:
+        layer_crs = src.crs
+    if not layer_crs:
+        # Without a CRS the bounds cannot be placed on the layer; read it all
+        return gpd.read_file(layer_path)
+    if bounds_crs:
+        bounds = transform_bounds(bounds_crs, layer_crs, *bounds, densify_pts=21)
+    return gpd.read_file(layer_path, bbox=tuple(bounds))
+
+def _summarise_band(values, total, bins):
+    # Statistics of the valid pixel values of one band
+    if values.size == 0:
+        return {'min': None, 'max': None, 'mean': None, 'std': None, 'nodata_fraction': 1.0,
+                'percentiles': None, 'histogram': None}
+    min_val, max_val = float(values.min()), float(values.max())
+    counts, edges = np.histogram(values, bins=bins, range=(min_val, max_val))
+    return {
+        'min': min_val,
+        'max': max_val,
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'nodata_fraction': 1.0 - values.size / total,
+        'percentiles': {f'p{q}': float(v) for q, v in zip(STAT_PERCENTILES, np.percentile(values, STAT_PERCENTILES))},
+        'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()},
+    }
+
+def _percentiles_from_histogram(counts, edges):
+    cdf = np.cumsum(counts) / counts.sum()
+    percentiles = {}
+    for q in STAT_PERCENTILES:
+        idx = min(int(np.searchsorted(cdf, q / 100.0)), len(counts) - 1)
+        below = cdf[idx - 1] if idx > 0 else 0.0
+        frac = (q / 100.0 - below) / (cdf[idx] - below) if cdf[idx] > below else 0.0
+        percentiles[f'p{q}'] = float(edges[idx] + frac * (edges[idx + 1] - edges[idx]))
+    return percentiles
+
+def _exact_band_statistics(src, band, bins, window_pixels=4_000_000):
+    # Two windowed passes over valid pixels: moments first, then a fine histogram
+    rows = max(1, window_pixels // src.width)
+    windows = [Window(0, r, src.width, min(rows, src.height - r)) for r in range(0, src.height, rows)]
+    count, total, sum_, sumsq = 0, 0, 0.0, 0.0
+    min_val, max_val = np.inf, -np.inf
+    for window in windows:
+        data = src.read(band, window=window, masked=True)
+        values = data.compressed().astype('float64')
+        total += data.size
+        if values.size:
+            count += values.size
+            sum_ += values.sum()
+            sumsq += np.square(values).sum()
+            min_val, max_val = min(min_val, values.min()), max(max_val, values.max())
+    if count == 0:
+        return _summarise_band(np.array([]), total, bins)
+
+    fine_bins = bins * 16
+    counts = np.zeros(fine_bins, dtype=np.int64)
+    for window in windows:
+        values = src.read(band, window=window, masked=True).compressed()
+        counts += np.histogram(values, bins=fine_bins, range=(min_val, max_val))[0]
+    edges = np.linspace(min_val, max_val, fine_bins + 1)
+    mean = sum_ / count
+    return {
+        'min': float(min_val),
+        'max': float(max_val),
+        'mean': float(mean),
+        'std': float(np.sqrt(max(sumsq / count - mean ** 2, 0.0))),
+        'nodata_fraction': 1.0 - count / total,
+        'percentiles': _percentiles_from_histogram(counts, edges),
+        'histogram': {'counts': counts.reshape(bins, 16).sum(axis=1).tolist(), 'edges': edges[::16].tolist()},
     }
 
+def raster_statistics(dataset_path, exact=False, max_size=1024, bins=64):
+    """Per-band min, max, mean, std, percentiles, histogram and nodata fraction over valid pixels.
+
+    By default the statistics come from one decimated read (served from overviews when
+    the file has them) and are flagged approximate; exact=True scans the full raster
+    window by window.
+    """
+    with rasterio.open(dataset_path) as src:
+        if exact:
+            bands = [_exact_band_statistics(src, band, bins) for band in range(1, src.count + 1)]
+        else:
+            scale = max(1.0, max(src.width, src.height) / max_size)
+            out_shape = (max(1, int(src.height / scale)), max(1, int(src.width / scale)))
+            bands = []
+            for band in range(1, src.count + 1):
+                data = src.read(band, out_shape=out_shape, masked=True)
+                bands.append(_summarise_band(data.compressed().astype('float64'), data.size, bins))
+    return {'approximate': not exact, 'bands': bands}
+
 # def save_metadata(dataset_upload_path):
 #     metadata = file_validation(dataset_upload_path)
 #     if metadata:
@@ -1,21 +1,26 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import HttpResponse, JsonResponse, FileResponse
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
-from .models import prospectivityProject, geospatialDatasets
-from .forms import ProspectivityProjectForm, GeospatialDatasetForm
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from .models import prospectivityProject, geospatialDatasets, MLmodelRun, UploadSession
+from .forms import ProspectivityProjectForm, GeospatialDatasetForm, UploadSessionForm
 from django.conf import settings
-import zipfile
-from pathlib import Path
+from django.db import transaction
 import os
 import shutil
 import traceback
-import geopandas as gpd
 import rasterio
+from rasterio.enums import Resampling
 from django.core.files.storage import FileSystemStorage
 from datetime import datetime
-import matplotlib.pyplot as plt
-from .tasks import crsHarmonization, resampleRaster, proximity_to_vector_task
-from .model_ML import load_and_generate_predictions
+from .tasks import (crsHarmonization, resampleRaster, proximity_to_vector_task, MLmodelRunTask,
+                    alignToProjectGrid, generateThumbnail, dispatch_project_pipeline, ingest_dataset,
+                    original_upload_path)
+from .utils import raster_statistics, vector_metadata
+from .uploads import (StagingUploadHandler, StagedUploadedFile, session_file_path, create_session_file, chunk_length,
+                      missing_chunks, read_chunk, write_chunk, discard_session, expire_upload_sessions)
+from .model_ML import BINARY_THRESHOLD
 import random
 import logging
 from django.contrib import messages
@@ -28,47 +33,28 @@ def upload_view(request):
     datasets = geospatialDatasets.objects.filter(project__isnull=True)
     return render(request, 'prospectivity/dataset_list.html', {'datasets': datasets})
 
+@csrf_exempt
 def dataset_upload(request, project_id):
+    # Stream the upload once into its own staging directory, hashing it on the way (see uploads.py).
+    # Upload handlers must be set before the CSRF check reads the body, hence the exempt/protect pair.
+    # Staged files are discarded however the request ends, a CSRF rejection included
+    handler = StagingUploadHandler(request)
+    request.upload_handlers = [handler]
+    try:
+        return _dataset_upload(request, project_id)
+    finally:
+        handler.discard()
+
+@csrf_protect
+def _dataset_upload(request, project_id):
     project = get_object_or_404(prospectivityProject, pk=project_id)
     if request.method == 'POST':
         form = GeospatialDatasetForm(request.POST, request.FILES)
+        file = request.FILES.get('file')
         if form.is_valid():
-            dataset = form.save(commit=False)
-            dataset.project_id = project_id
-            dataset.status = "Validated"
-            file = request.FILES['file']
-            tmp_dir = os.path.join(settings.MEDIA_ROOT, 'tmp')
-            if not os.path.exists(tmp_dir):
-                os.makedirs(tmp_dir)
-            temp_file_path = os.path.join(tmp_dir, file.name)
-            print(file.name)
-            print("temp file path", temp_file_path)
-            with open(temp_file_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
-                print("file saved")
-
             try:
-                metadata = file_validation(temp_file_path)
-                if metadata["dataset_types"].lower() != form.cleaned_data["dataset_types"].lower():
-                    return JsonResponse({'error': 'File type does not match actual content'}, status=400)
-
-                dataset.dataset_names = form.cleaned_data["dataset_names"]
-                dataset.dataset_types = metadata.get("dataset_types")
-                dataset.crs = form.cleaned_data.get("crs")
-                dataset.band_info = form.cleaned_data.get("band_info")
-                dataset.updated_on = datetime.today().date()
-                print("datetime", dataset.updated_on)
-                dataset.file.save(file.name, file, save=False)
-                dataset.save()
-                os.remove(temp_file_path)
-                generate_thumbnail(dataset.id)
+                save_staged_dataset(form, project_id, file)
                 datasets = geospatialDatasets.objects.filter(project_id=project_id)
-                
-                 # Clean up everything in the tmp directory
-                tmp_dir = os.path.join(settings.MEDIA_ROOT, 'tmp')
-                if os.path.exists(tmp_dir):
-                    shutil.rmtree(tmp_dir)
 
                 return render(request, 'prospectivity/partials/upload_form.html', {'datasets': datasets})
 
@@ -93,6 +79,149 @@ def dataset_upload(request, project_id):
         'project_id': project_id,
     })
 
+def save_staged_dataset(form, project_id, file):
+    # Validate a staged upload (see uploads.py) against its form, move it into place and queue the ingest
+    dataset = form.save(commit=False)
+    dataset.project_id = project_id
+    dataset.status = "Validated"
+    staged_path = file.temporary_file_path()
+    print(file.name)
+    print("staged file path", staged_path)
+
+    metadata = file_validation(staged_path)
+    if metadata["dataset_types"].lower() != form.cleaned_data["dataset_types"].lower():
+        raise ValueError('File type does not match actual content')
+
+    dataset.dataset_names = form.cleaned_data["dataset_names"]
+    dataset.dataset_types = metadata.get("dataset_types")
+    dataset.crs = form.cleaned_data.get("crs")
+    dataset.band_info = form.cleaned_data.get("band_info")
+    dataset.band_statistics = metadata.get("band_statistics")
+    dataset.geometry_types = metadata.get("geometry_types")
+    dataset.file_hash = file.sha256
+    dataset.updated_on = datetime.today().date()
+    print("datetime", dataset.updated_on)
+    # The staged file is renamed into place, not copied
+    file.close()
+    dataset.file.save(file.name, file, save=False)
+    dataset.save()
+    ingest_dataset(dataset)
+    return dataset
+
+
+#resumable chunked uploads, for files too large for a single form post
+def upload_session_json(session):
+    session_url = reverse('upload_session_status', args=[session.id])
+    return {
+        'id': str(session.id),
+        'status': session.status,
+        'file_size': session.file_size,
+        'chunk_size': session.chunk_size,
+        'received': sorted(int(offset) for offset in session.received_chunks),
+        'session_url': session_url,
+        # Chunks go to <session_url>chunk/<offset>/
+        'complete_url': reverse('upload_session_complete', args=[session.id]),
+    }
+
+def upload_session_create(request, project_id):
+    # Takes the dataset form fields plus file_name and file_size; the file itself follows in chunks
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    project = get_object_or_404(prospectivityProject, pk=project_id)
+    form = UploadSessionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'error': 'Invalid upload', 'details': form.errors.as_json()}, status=400)
+    expire_upload_sessions()
+    session = form.save(commit=False)
+    session.project = project
+    session.chunk_size = getattr(settings, 'UPLOAD_CHUNK_SIZE', 16 * 1024 * 1024)
+    session.save()
+    create_session_file(session)
+    print(f"Upload session {session.id} opened for {session.file_name} ({session.file_size} bytes)")
+    return JsonResponse(upload_session_json(session), status=201)
+
+def upload_session_status(request, session_id):
+    # Lets a client resume: only the chunks missing from `received` need to be sent again
+    session = get_object_or_404(UploadSession, id=session_id)
+    return JsonResponse(upload_session_json(session))
+
+def upload_session_chunk(request, session_id, offset):
+    # PUT of the raw chunk bytes at a chunk boundary, with their sha256 in X-Chunk-SHA256
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'PUT required'}, status=405)
+    session = get_object_or_404(UploadSession, id=session_id)
+    if session.status != "Open":
+        return JsonResponse({'error': f'Upload session is {session.status}'}, status=409)
+    length = chunk_length(session, offset)
+    if length is None:
+        return JsonResponse({'error': f'{offset} is not a chunk offset'}, status=400)
+    if int(request.META.get('CONTENT_LENGTH') or 0) != length:
+        return JsonResponse({'error': f'Chunk at {offset} must be {length} bytes'}, status=400)
+    checksum = request.headers.get('X-Chunk-SHA256', '').lower()
+    if not checksum:
+        return JsonResponse({'error': 'X-Chunk-SHA256 header required'}, status=400)
+
+    # Verified before it is written, so a corrupt retry never overwrites bytes already accepted at this offset;
+    # only one chunk (at most UPLOAD_CHUNK_SIZE) is held in memory
+    try:
+        data, sha256 = read_chunk(request, length)
+    except (OSError, ValueError) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if sha256 != checksum:
+        return JsonResponse({'error': f'Checksum mismatch for chunk at {offset}'}, status=400)
+    try:
+        write_chunk(session, offset, data)
+    except OSError as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+    # Parallel chunks of the same session record themselves one at a time
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().get(id=session_id)
+        session.received_chunks[str(offset)] = sha256
+        session.save(update_fields=['received_chunks', 'updated_on'])
+    return JsonResponse({'offset': offset, 'sha256': sha256, 'received': len(session.received_chunks)})
+
+def upload_session_complete(request, session_id):
+    # Once every chunk is in, the assembled file goes through the same form and validation as dataset_upload
+    if request.method != 'POST':
+        return JsonResponse({'error': 'POST required'}, status=405)
+    with transaction.atomic():
+        session = get_object_or_404(UploadSession.objects.select_for_update(), id=session_id)
+        if session.status != "Open":
+            return JsonResponse({'error': f'Upload session is {session.status}'}, status=409)
+        missing = missing_chunks(session)
+        if missing:
+            return JsonResponse({'error': f'{len(missing)} chunks missing', 'missing': missing}, status=409)
+        session.status = "Assembling"
+        session.save(update_fields=['status', 'updated_on'])
+
+    file = None
+    try:
+        file = StagedUploadedFile(session_file_path(session), session.file_name, None, None, mode='rb')
+        form = GeospatialDatasetForm({
+            'dataset_names': session.dataset_names,
+            'dataset_types': session.dataset_types,
+            'crs': session.crs,
+            'band_info': session.band_info,
+        }, {'file': file})
+        if not form.is_valid():
+            session.status = "Failed"
+            return JsonResponse({'error': 'Invalid dataset', 'details': form.errors.as_json()}, status=400)
+        session.dataset = save_staged_dataset(form, session.project_id, file)
+        session.status = "Complete"
+        datasets = geospatialDatasets.objects.filter(project_id=session.project_id)
+        return render(request, 'prospectivity/partials/upload_form.html', {'datasets': datasets})
+    except Exception as e:
+        print(traceback.format_exc())
+        session.status = "Failed"
+        return JsonResponse({'error': str(e)}, status=400)
+    finally:
+        # The session directory goes whatever happened, even if the file never opened
+        if file is not None:
+            file.close()
+        discard_session(session)
+        session.save(update_fields=['status', 'dataset', 'updated_on'])
+
 def file_validation(dataset_upload_path):
     extension = os.path.splitext(dataset_upload_path)[1].lower()
     if extension in ['.tif', '.tiff']:
@@ -108,42 +237,14 @@ def validate_raster(dataset_upload_path):
             "dataset_types": "raster",
             "crs": str(src.crs),
             "band_info": src.count,
-            "geometry_types": None
+            "geometry_types": None,
+            # Quick statistics from a decimated read; refined in the background after upload
+            "band_statistics": raster_statistics(dataset_upload_path),
         }
 
 def validate_vector_zip(dataset_upload_path):
-    # Use the directory containing the uploaded zip file
-    temp_dir = os.path.dirname(dataset_upload_path)
-    # Extract zip file to the same directory
-    with zipfile.ZipFile(dataset_upload_path, 'r') as zip_ref:
-        zip_ref.extractall(temp_dir)
-    
-    # Find shapefile (.shp) in extracted files
-    shp_file = None
-    for file in Path(temp_dir).rglob('*.shp'):
-        shp_file = str(file)
-        break
-    
-    if not shp_file:
-        raise ValueError("No shapefile found in zip archive")
-    
-    try:
-        # Read and validate shapefile
-        gdf = gpd.read_file(shp_file)
-        geometry_types = list(gdf.geometry.type.unique())
-        
-        return {
-            "dataset_types": "vector",
-            "crs": str(gdf.crs),
-            "band_info": None,
-            "geometry_types": ",".join(geometry_types)
-        }
-    finally:
-        for file in Path(temp_dir).glob('*.shp') or Path(temp_dir).glob('*.shx') or Path(temp_dir).glob('*.dbf') or Path(temp_dir).glob('*.prj'):
-            try:
-                os.remove(file)
-            except OSError:
-                pass
+    # Layer metadata only, read inside the archive without extracting it
+    return vector_metadata(dataset_upload_path)
 
 def project_view(request):
     projects = prospectivityProject.objects.all()
@@ -228,7 +329,7 @@ def upload_dataset(request, project_id):
             dataset.project = project
             dataset.status = "Validated"
             dataset.save()
-            generate_thumbnail(dataset.id)
+            ingest_dataset(dataset)
             datasets = geospatialDatasets.objects.filter(project_id=project_id)
             return render(request, 'prospectivity/partials/upload_form.html', {'datasets': datasets})
     return redirect('project_detail', project_id=project_id)
@@ -240,6 +341,10 @@ def dataset_delete(request, dataset_id):
     # Delete the file from the filesystem
     if dataset.file and dataset.file.path and os.path.exists(dataset.file.path):
         os.remove(dataset.file.path)
+    if dataset.file and os.path.exists(original_upload_path(dataset.file.path)):
+        os.remove(original_upload_path(dataset.file.path))
+    if dataset.processed_file and os.path.exists(dataset.processed_file.path):
+        os.remove(dataset.processed_file.path)
 
     # Delete thumbnail if exists
     if dataset.thumbnail:
@@ -259,6 +364,10 @@ def trigger_crs(request, dataset_id):
     try:
         dataset = get_object_or_404(geospatialDatasets, id=dataset_id)
         print(f"Dataset found: {dataset.dataset_names}, Current Status: {dataset.status}")
+        # Resampling kernel for rasters: nearest (default, for classified data), bilinear, cubic, ...
+        resampling = request.GET.get("resampling", "nearest")
+        if resampling not in Resampling.__members__:
+            return JsonResponse({"error": f"Unknown resampling method: {resampling}"}, status=400)
         dataset.status = "Preprocessing"
         dataset.task_message = "Starting CRS Harmonization"
         dataset.save()
@@ -268,7 +377,7 @@ def trigger_crs(request, dataset_id):
             return JsonResponse({"error": "No project associated with dataset"}, status=400)
         target_crs = dataset.project.target_crs if dataset.project.target_crs else "EPSG:4326"
         print(f"Target CRS: {target_crs}")
-        task = crsHarmonization.delay(dataset_id, target_crs)
+        task = crsHarmonization.delay(dataset_id, target_crs, resampling)
         print(f"Celery task triggered: {task.id}")
         return JsonResponse({"status": dataset.status, "task_message": dataset.task_message})
     except Exception as e:
@@ -312,6 +421,28 @@ def trigger_resample(request, dataset_id):
         return JsonResponse({"error": str(e)}, status=500)
 
 
+def trigger_align(request, dataset_id):
+    print(f"Triggering alignment to project grid for dataset ID: {dataset_id}")
+    try:
+        dataset = get_object_or_404(geospatialDatasets, id=dataset_id)
+        print(f"Dataset found: {dataset.dataset_names}, Current Status: {dataset.status}")
+        # Bilinear suits continuous grids; pass ?resampling=nearest for classified rasters
+        resampling = request.GET.get("resampling", "bilinear")
+        if resampling not in Resampling.__members__:
+            return JsonResponse({"error": f"Unknown resampling method: {resampling}"}, status=400)
+        if not dataset.project:
+            print("No project associated with dataset")
+            return JsonResponse({"error": "No project associated with dataset"}, status=400)
+        dataset.status = "Preprocessing"
+        dataset.task_message = "Aligning to project grid"
+        dataset.save()
+        task = alignToProjectGrid.delay(dataset_id, resampling)
+        print(f"Celery align task triggered: {task.id}")
+        return JsonResponse({"status": dataset.status, "task_message": dataset.task_message})
+    except Exception as e:
+        print(f"Error in trigger_align: {str(e)}")
+        return JsonResponse({"error": str(e)}, status=500)
+
 
 def trigger_proximity(request, dataset_id):
     print(f"Triggering Proximity Calculation for dataset ID: {dataset_id}")
@@ -327,25 +458,10 @@ def trigger_proximity(request, dataset_id):
             print("No project associated with dataset")
             return JsonResponse({"error": "No project associated with dataset"}, status=400)
 
-        # Extract .zip if necessary
-        vector_path = dataset.file.path
-        if vector_path.endswith('.zip'):
-            temp_dir = os.path.join(os.path.dirname(vector_path), f"temp_{dataset_id}")
-            os.makedirs(temp_dir, exist_ok=True)
-            with zipfile.ZipFile(vector_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-            # Find the .shp file in the extracted contents
-            for file in os.listdir(temp_dir):
-                if file.endswith('.shp'):
-                    vector_path = os.path.join(temp_dir, file)
-                    break
-            if not vector_path.endswith('.shp'):
-                shutil.rmtree(temp_dir)
-                raise ValueError("No .shp file found in the zip archive")
-
-        task = proximity_to_vector_task.delay(dataset_id, vector_path, temp_dir)
+        # The task reads the FlatGeobuf made at ingest (or the zipped layer in place); the thumbnail
+        # is drawn once the proximity raster exists
+        task = (proximity_to_vector_task.si(dataset_id) | generateThumbnail.si(dataset_id)).delay()
         print(f"Celery proximity task triggered: {task.id}")
-        generate_thumbnail(dataset.id)
         return JsonResponse({"status": dataset.status, "task_message": dataset.task_message, "task_id": task.id})
 
     except Exception as e:
@@ -358,18 +474,6 @@ def status_view(request, dataset_id):
     dataset = get_object_or_404(geospatialDatasets, id=dataset_id)
     return JsonResponse({"status": dataset.status,"task_message": dataset.task_message or ""})
 
-def generate_thumbnail(dataset_id):
-    dataset = get_object_or_404(geospatialDatasets, id=dataset_id)
-    if dataset.dataset_types == 'raster':
-        thumbnail_dir = os.path.join(settings.MEDIA_ROOT, 'thumbnails')
-        os.makedirs(thumbnail_dir, exist_ok=True)  # Create thumbnails directory if it doesn't exist
-        thumbnail_path = os.path.join(thumbnail_dir, f'{dataset.id}.png')
-        with rasterio.open(dataset.file.path) as src:
-            data = src.read(1)
-            plt.imsave(thumbnail_path, data, cmap='viridis', vmin=0, vmax=255)
-            dataset.thumbnail = f'thumbnails/{dataset.id}.png'
-            dataset.save()
-
 def map_view(request):
     return render(request, 'prospectivity/map.html')
 
@@ -381,6 +485,33 @@ def home(request):
 
 
 
+def run_project_pipeline(request, project_id):
+    # Prepare every dataset of the project on the workers, then run the CNN prediction
+    project = get_object_or_404(prospectivityProject, id=project_id)
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST required'}, status=405)
+    if not geospatialDatasets.objects.filter(project=project).exists():
+        return JsonResponse({'status': 'error', 'message': 'No datasets found for this project.'}, status=400)
+    try:
+        model_run = MLmodelRun.objects.create(
+            project=project,
+            model_name='CNN',
+            algorithms_used='CNN',
+            parameters={'batch_size': 16, 'threshold': BINARY_THRESHOLD, 'pipeline': True},
+            status='Pending',
+            task_message='Queued for preprocessing',
+        )
+        dispatch_project_pipeline(project, model_run)
+        return JsonResponse({
+            'status': 'queued',
+            'message': model_run.task_message,
+            'run_id': model_run.id,
+            'status_url': reverse('prediction_status', args=[model_run.id]),
+        }, status=202)
+    except Exception as e:
+        logger.error(f"Error starting project pipeline: {str(e)}\n{traceback.format_exc()}")
+        return JsonResponse({'status': 'error', 'message': f"Error starting pipeline: {str(e)}"}, status=500)
+
 def select_and_predict_datasets(request, project_id):
     project = get_object_or_404(prospectivityProject, id=project_id)
     project_folder = os.path.join(settings.MEDIA_ROOT, 'geospatial_datasets', project.name)
@@ -401,35 +532,28 @@ def select_and_predict_datasets(request, project_id):
             if not selected_datasets.exists():
                 return JsonResponse({'status': 'error', 'message': 'No raster datasets found for this project.'}, status=400)
 
-            tif_paths = [dataset.file.path for dataset in selected_datasets]
-            logger.info(f"Running predictions for files: {tif_paths}")
-            load_and_generate_predictions(tif_paths, output_dir)
-
-            heatmap_path = os.path.join(output_dir, 'prediction_map.png')
-            csv_path = os.path.join(output_dir, 'predictions.csv')
-            world_map_path = os.path.join(output_dir, 'world_map_with_heatmap.html')
-            
-            heatmap_url = None
-            csv_url = None
-            world_map_url = None
-            
-            if os.path.exists(heatmap_path):
-                heatmap_url = os.path.join(settings.MEDIA_URL, 'geospatial_datasets', project.name, 'outputs', 'prediction_map.png')
-            if os.path.exists(csv_path):
-                csv_url = os.path.join(settings.MEDIA_URL, 'geospatial_datasets', project.name, 'outputs', 'predictions.csv')
-            if os.path.exists(world_map_path):
-                world_map_url = os.path.join(settings.MEDIA_URL, 'geospatial_datasets', project.name, 'outputs', 'world_map_with_heatmap.html')
+            # Prediction runs on a Celery worker; the client polls the run for progress
+            model_run = MLmodelRun.objects.create(
+                project=project,
+                model_name='CNN',
+                algorithms_used='CNN',
+                parameters={'batch_size': 16, 'threshold': BINARY_THRESHOLD},
+                status='Pending',
+                task_message='Queued for prediction',
+            )
+            model_run.input_data.set(selected_datasets)
+            logger.info(f"Queued model run {model_run.id} for files: {[d.file.path for d in selected_datasets]}")
+            MLmodelRunTask.delay(model_run.id)
 
             return JsonResponse({
-                'status': 'success',
-                'message': 'Predictions completed successfully!',
-                'heatmap_url': heatmap_url,
-                'csv_url': csv_url,
-                'world_map_url': world_map_url
-            })
+                'status': 'queued',
+                'message': model_run.task_message,
+                'run_id': model_run.id,
+                'status_url': reverse('prediction_status', args=[model_run.id]),
+            }, status=202)
 
         except Exception as e:
-            logger.error(f"Error during prediction: {str(e)}\n{traceback.format_exc()}")
+            logger.error(f"Error queueing prediction: {str(e)}\n{traceback.format_exc()}")
             return JsonResponse({'status': 'error', 'message': f"Error during prediction: {str(e)}"}, status=500)
 
     datasets = geospatialDatasets.objects.filter(project_id=project_id)
@@ -457,6 +581,21 @@ def select_and_predict_datasets(request, project_id):
     }
     return render(request, 'prospectivity/project_detail.html', context)
 
+def prediction_status_view(request, run_id):
+    model_run = get_object_or_404(MLmodelRun, id=run_id)
+    outputs = model_run.outputs or {}
+    media_url = str(settings.MEDIA_URL)
+    return JsonResponse({
+        'run_id': model_run.id,
+        'status': model_run.status,
+        'task_message': model_run.task_message or "",
+        'performance_metrics': model_run.performance_metrics,
+        'heatmap_url': media_url + outputs['heatmap'] if 'heatmap' in outputs else None,
+        'csv_url': media_url + outputs['csv'] if 'csv' in outputs else None,
+        'world_map_url': media_url + outputs['world_map'] if 'world_map' in outputs else None,
+        'probability_map_url': media_url + outputs['probability_map'] if 'probability_map' in outputs else None,
+    })
+
 def download_predictions_csv(request, project_id):
     project = get_object_or_404(prospectivityProject, id=project_id)
     csv_path = os.path.join(settings.MEDIA_ROOT, 'geospatial_datasets', 